@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import shlex
+import subprocess
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from vllm_server import free_port, wait_for_server
+
+
+def remove_outputs(output_file):
+    # Every benchmark run starts from scratch instead of resuming the last one
+    for path in [output_file, output_file + ".journal", output_file + ".responses"]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def summarize(throughput_report, output_file, wall_time):
+    with open(throughput_report, "r", encoding="utf-8") as f:
+        summary = json.load(f)["summary"]
+    hops = []
+    if os.path.exists(output_file):
+        with open(output_file, "r", encoding="utf-8") as f:
+            hops = [json.loads(line).get("total_round", 0) for line in f]
+    return {
+        "messages": len(hops),
+        "messages_per_second": summary["messages_per_second"],
+        "prompts_per_second": summary["prompts_per_second"],
+        "rounds": summary["rounds"],
+        "mean_hops_per_message": round(sum(hops) / len(hops), 3) if hops else 0.0,
+        "max_hops_per_message": max(hops) if hops else 0,
+        "generate_time": summary["generate_time"],
+        "client_overhead_time": summary["client_overhead_time"],
+        "run_batch_wall_time": round(wall_time, 3),
+    }
+
+
+def main(args, run_batch_args):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.join(ROOT, "src") + os.pathsep + env.get("PYTHONPATH", "")
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_file = os.path.join(args.output_dir, f"{args.label}_output.jsonl")
+    throughput_report = os.path.join(args.output_dir, f"{args.label}_throughput.json")
+    remove_outputs(output_file)
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}/v1"
+    server_cmd = [sys.executable, os.path.join(ROOT, "mock_server.py"), "--port", str(port), "--model", args.model] + shlex.split(args.server_args)
+    server = subprocess.Popen(server_cmd, env=env)
+    try:
+        wait_for_server(base_url, server)
+        run_batch_cmd = [
+            sys.executable, os.path.join(ROOT, "run_batch.py"),
+            "--output_file", output_file,
+            "--input_file", args.input_file,
+            "--dataset_name", args.dataset_name,
+            "--raw2clean_path", args.raw2clean_path,
+            "--head", str(args.head),
+            "--llm_in_use", args.model,
+            "--llm_url", base_url,
+            "--inference_mode", "api",
+            "--throughput_report", throughput_report,
+        ] + run_batch_args
+        print(f"Running: {' '.join(run_batch_cmd)}", flush=True)
+        start_time = time.time()
+        subprocess.run(run_batch_cmd, env=env, check=True, stdout=None if args.verbose else subprocess.DEVNULL)
+        wall_time = time.time() - start_time
+    finally:
+        server.terminate()
+        server.wait()
+
+    result = {
+        "label": args.label,
+        "server_args": args.server_args,
+        "run_batch_args": run_batch_args,
+        **summarize(throughput_report, output_file, wall_time),
+    }
+    print(json.dumps(result, indent=2))
+    result_file = os.path.join(args.output_dir, f"{args.label}_benchmark.json")
+    with open(result_file, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(f"Benchmark result saved to {result_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run run_batch.py end to end against mock_server.py. Arguments not listed here are passed on to run_batch.py."
+    )
+    parser.add_argument(
+        "--label", type=str, default="benchmark", help="name of this run, prefixes the files in output_dir"
+    )
+    parser.add_argument(
+        "--output_dir", type=str, default="./benchmark_results", help="directory for the output, throughput report and benchmark result"
+    )
+    parser.add_argument(
+        "--input_file", type=str, default="./data/TabFact/test.jsonl", help="path to dataset input"
+    )
+    parser.add_argument(
+        "--dataset_name", type=str, default="TabFact", help="which dataset to run"
+    )
+    parser.add_argument(
+        "--raw2clean_path", type=str, default="./data/TabFact/raw2clean.jsonl", help="special file for tabfact dataset"
+    )
+    parser.add_argument(
+        "--head", type=int, default=500, help="head of the dataset to run"
+    )
+    parser.add_argument(
+        "--model", type=str, default="gpt-4o-mini",
+        help="model id served by the mock server, the dataset loader needs its Hugging Face or tiktoken tokenizer"
+    )
+    parser.add_argument(
+        "--server_args", type=str, default="", help='arguments of mock_server.py, e.g. "--time_scale 0.1 --rate_limit_rate 0.02"'
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the output of run_batch.py"
+    )
+    args, run_batch_args = parser.parse_known_args()
+    main(args, run_batch_args)
@@ -100,6 +100,7 @@ def main(args):
             fp.write(json.dumps(msg, ensure_ascii=False) + "\n")
 
     print(f"Memory-enriched user messages saved to: {args.output_file}")
+    ms.llm.close()
 
 
 if __name__ == "__main__":
@@ -134,6 +135,15 @@ if __name__ == "__main__":
     parser.add_argument(
         "--llm_api_key", type=str, required=False, help=" ", default="None"
     )
+    parser.add_argument(
+        "--tensor_parallel_size", type=int, default=2, help="tensor parallel size of the vLLM server started in api_self_hosted mode"
+    )
+    parser.add_argument(
+        "--keep_vllm", action="store_true", help="leave the vLLM server started in api_self_hosted mode running, the next script reuses it"
+    )
+    parser.add_argument(
+        "--max_model_len", type=int, default=None, help=f"context length of the served model, requests' max_tokens are clamped so prompt plus output fit; default {MAX_MODEL_LEN} for a self-hosted server or offline, no clamping for other API endpoints"
+    )
     parser.add_argument(
         "--inference_mode", type=str, default="api_self_hosted", help="inference mode, offline_vllm or api or api_self_hosted or oai_batch"
     )
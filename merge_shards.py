@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import argparse
+
+from utils import *
+from const import *
+
+
+def main(args):
+    if args.num_shards < 2:
+        # run_batch.py does not shard then, output_file is already the complete result
+        raise ValueError(f"--num_shards must be at least 2 to merge shards, got {args.num_shards}; "
+                         f"with a single shard {args.output_file} is already the complete output")
+    shard_files = [shard_file_path(args.output_file, args.num_shards, k) for k in range(args.num_shards)]
+    for shard_file in shard_files:
+        if not os.path.exists(shard_file):
+            raise FileNotFoundError(f"Missing shard output {shard_file}")
+        if os.path.exists(shard_file + ".journal"):
+            raise RuntimeError(f"{shard_file} has not been compacted yet, is the shard still running?")
+
+    user_messages = []
+    for shard_file in shard_files:
+        with open(shard_file, "r", encoding="utf-8") as f:
+            shard = [json.loads(line) for line in f]
+        print(f"Loaded {len(shard)} user messages from {shard_file}")
+        user_messages.extend(shard)
+
+    unfinished = sum(1 for user_message in user_messages if user_message["send_to"] != END_NAME)
+    if unfinished > 0:
+        print(f"Warning: {unfinished} user messages have not reached {END_NAME}")
+
+    # Restore the original dataset order
+    user_messages.sort(key=lambda user_message: user_message["dataset_index"])
+    with open(args.output_file, "w", encoding="utf-8") as fp:
+        for user_message in user_messages:
+            user_message.pop("dataset_index")
+            fp.write(json.dumps(user_message, ensure_ascii=False) + "\n")
+    print(f"Merged {len(user_messages)} user messages into {args.output_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--output_file", type=str, required=True, help="the output_file passed to every run_batch.py shard"
+    )
+    parser.add_argument(
+        "--num_shards", type=int, required=True, help="the num_shards passed to every run_batch.py shard"
+    )
+    args = parser.parse_args()
+
+    main(args=args)
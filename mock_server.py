@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+import json
+import math
+import random
+import signal
+import sys
+import threading
+import time
+import uuid
+import argparse
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+
+from const import MAX_MODEL_LEN
+from mock_responder import MockResponder
+from rate_limiter import estimate_tokens
+
+
+class LatencyModel(object):
+    """
+    Synthetic request latency: a fixed overhead, prefill time proportional to
+    the prompt tokens and decode time proportional to the output tokens, with
+    log-normal jitter. time_scale shrinks or stretches every latency at once.
+    """
+    def __init__(self, base_latency, prefill_tps, decode_tps, jitter, time_scale, seed):
+        self.base_latency = base_latency
+        self.prefill_tps = prefill_tps
+        self.decode_tps = decode_tps
+        self.jitter = jitter
+        self.time_scale = time_scale
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def noise(self):
+        with self.lock:
+            return math.exp(self.rng.gauss(0.0, self.jitter)) if self.jitter > 0 else 1.0
+
+    def prefill_time(self, prompt_tokens):
+        return (self.base_latency + prompt_tokens / self.prefill_tps) * self.noise() * self.time_scale
+
+    def decode_time(self, completion_tokens):
+        return completion_tokens / self.decode_tps * self.noise() * self.time_scale
+
+
+class MockState(object):
+    """Configuration and counters shared by the request handler threads."""
+    def __init__(self, args):
+        self.model = args.model
+        self.max_model_len = args.max_model_len
+        self.responder = MockResponder(seed=args.seed, not_ready_rate=args.not_ready_rate, pass_rate=args.pass_rate,
+                                       invalid_rate=args.invalid_rate, filler_words=args.filler_words)
+        self.latency = LatencyModel(args.base_latency, args.prefill_tps, args.decode_tps, args.jitter, args.time_scale, args.seed)
+        self.error_rate = args.error_rate
+        self.rate_limit_rate = args.rate_limit_rate
+        # Requests beyond max_running wait for a slot, like a server at its batch size limit
+        self.slots = threading.BoundedSemaphore(args.max_running)
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "completed": 0, "errors": 0, "rate_limited": 0, "aborted": 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def draw(self):
+        with self.lock:
+            return self.rng.random()
+
+
+def truncate(content, max_tokens, stop):
+    """Apply the request's stop sequences and max_tokens (about 4 characters per token)."""
+    for sequence in ([stop] if isinstance(stop, str) else stop or []):
+        if sequence and sequence in content:
+            content = content[: content.index(sequence)]
+    if max_tokens is not None and len(content) > max_tokens * 4:
+        return content[: max_tokens * 4], "length"
+    return content, "stop"
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") in ["/v1/models", "/models"]:
+            self.send_json(200, {"object": "list", "data": [{"id": self.state.model, "object": "model", "owned_by": "mock",
+                                                             "max_model_len": self.state.max_model_len}]})
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.path.rstrip("/") not in ["/v1/chat/completions", "/chat/completions"]:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        self.state.count("requests")
+        draw = self.state.draw()
+        if draw < self.state.rate_limit_rate:
+            self.state.count("rate_limited")
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}}, {"Retry-After": "1"})
+            return
+        if draw < self.state.rate_limit_rate + self.state.error_rate:
+            self.state.count("errors")
+            self.send_json(500, {"error": {"message": "Internal server error", "type": "server_error"}})
+            return
+
+        messages = request.get("messages", [])
+        content, finish_reason = truncate(self.state.responder.respond(messages), request.get("max_tokens"), request.get("stop"))
+        prompt_tokens = estimate_tokens(messages)
+        completion_tokens = estimate_tokens(content)
+        with self.state.slots:
+            time.sleep(self.state.latency.prefill_time(prompt_tokens))
+            if request.get("stream"):
+                self.stream(content, finish_reason, completion_tokens)
+            else:
+                time.sleep(self.state.latency.decode_time(completion_tokens))
+                self.send_json(200, {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": self.state.model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                              "total_tokens": prompt_tokens + completion_tokens},
+                })
+                self.state.count("completed")
+
+    def stream(self, content, finish_reason, completion_tokens):
+        """Server-sent events with one chunk of about 4 tokens at a time, the decode time is spread over the chunks."""
+        chunks = [content[start:start + 16] for start in range(0, len(content), 16)]
+        chunk_time = self.state.latency.decode_time(completion_tokens) / max(1, len(chunks))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        def event(delta, finish=None):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": self.state.model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+            }
+            self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        # Without a length the end of the stream is the end of the connection
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            event({"role": "assistant", "content": ""})
+            for chunk in chunks:
+                time.sleep(chunk_time)
+                event({"content": chunk})
+            event({}, finish_reason)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            self.state.count("completed")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading, e.g. once the JSON object it waits for is complete
+            self.state.count("aborted")
+
+
+def main(args):
+    MockHandler.state = MockState(args)
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    server.daemon_threads = True
+    # benchmark.py stops the server with SIGTERM, the stats are printed either way
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Mock OpenAI-compatible server for {args.model} at http://{args.host}:{server.server_address[1]}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Mock server stats: {MockHandler.state.counts}", flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host", type=str, default="127.0.0.1", help="address to listen on"
+    )
+    parser.add_argument(
+        "--port", type=int, default=9876, help="port to listen on"
+    )
+    parser.add_argument(
+        "--model", type=str, default="mock-model", help="model id served at /v1/models, pass it as --llm_in_use"
+    )
+    parser.add_argument(
+        "--max_model_len", type=int, default=MAX_MODEL_LEN, help="context length reported at /v1/models, like vLLM's"
+    )
+    parser.add_argument(
+        "--base_latency", type=float, default=0.05, help="fixed seconds of every request"
+    )
+    parser.add_argument(
+        "--prefill_tps", type=float, default=8000.0, help="prompt tokens processed per second"
+    )
+    parser.add_argument(
+        "--decode_tps", type=float, default=60.0, help="output tokens generated per second"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.2, help="standard deviation of the log-normal latency noise"
+    )
+    parser.add_argument(
+        "--time_scale", type=float, default=1.0, help="multiplies every latency, e.g. 0.1 for a quick run"
+    )
+    parser.add_argument(
+        "--max_running", type=int, default=64, help="requests served at once, later ones queue"
+    )
+    parser.add_argument(
+        "--error_rate", type=float, default=0.0, help="fraction of requests answered with a 500 error"
+    )
+    parser.add_argument(
+        "--rate_limit_rate", type=float, default=0.0, help="fraction of requests answered with a 429 error"
+    )
+    parser.add_argument(
+        "--invalid_rate", type=float, default=0.0, help="fraction of JSON agent responses that are plain text instead"
+    )
+    parser.add_argument(
+        "--not_ready_rate", type=float, default=0.3, help="fraction of Solver responses that transform the table instead of answering"
+    )
+    parser.add_argument(
+        "--pass_rate", type=float, default=0.7, help="fraction of Checker responses that accept the answer"
+    )
+    parser.add_argument(
+        "--filler_words", type=int, default=40, help="words in every free-text field, sets the output length"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="seed of responses, errors and latencies"
+    )
+    args = parser.parse_args()
+    main(args)
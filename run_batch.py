@@ -1,12 +1,93 @@
 # -*- coding: utf-8 -*-
 import os
 import json
+import socket
 import argparse
 
 from utils import *
 from agents import *
 from coordinator import *
 from const import *
+from journal import *
+from work_queue import WorkQueue
+
+
+def load_user_messages(args, sharded=False):
+    """
+    With sharded, only the messages of args.shard_index are loaded, dropped before
+    their tables are processed, and each keeps its dataset_index for merge_shards.py.
+    """
+    select = None
+    if sharded:
+        select = lambda qs_id: shard_of(qs_id, args.num_shards) == args.shard_index
+    if args.dataset_name == TAB_NAME:
+        tabfact_df = load_tabfact_dataset(args, select=select)
+        user_messages = init_TabFact_messages(tabfact_df, args.start_agent)[: args.head]
+    else:
+        wiki_data = load_wikiTQ_data(args.input_file, head=args.head, select=select)
+        wiki_data = preload_wiki_data(args, wiki_data)
+        user_messages = init_wikiTQ_messages(wiki_data, args.start_agent)[: args.head]
+    return user_messages
+
+
+def report_throughput(coordinator, args):
+    summary = coordinator.report.summary()
+    print(f"Throughput summary: {summary}")
+    if args.baseline_report is not None:
+        with open(args.baseline_report, "r", encoding="utf-8") as f:
+            baseline = json.load(f)['summary']
+        for agent_name, stats in compare_invalid_formats(summary, baseline).items():
+            print(f"{agent_name}: {stats['invalid_formats']} invalid format responses, "
+                  f"{stats['baseline_invalid_formats']} in the baseline run, {stats['rounds_saved']} retry rounds saved")
+    if args.throughput_report is not None:
+        coordinator.report.save(args.throughput_report)
+
+
+def run_queue_worker(args):
+    queue = WorkQueue(args.work_queue, lease_seconds=args.lease_seconds)
+    if queue.is_empty():
+        print(f"Enqueuing user_messages into {args.work_queue}")
+        queue.enqueue(load_user_messages(args))
+    coordinator = Coordinator(args)
+    print(f"Worker {args.worker_id} pulling from {args.work_queue}")
+    if coordinator.process_work_queue(queue, args.worker_id, args, lease_size=args.lease_size):
+        queue.export(args.output_file)
+        print(f"All user messages finished, exported to {args.output_file}")
+    else:
+        print(f"All user messages finished, another worker exports {args.output_file}")
+    report_throughput(coordinator, args)
+    queue.close()
+    coordinator.llm.close()
+
+
+def run_stream(args):
+    # Resume by skipping the messages that already reached the output
+    finished_ids = set()
+    if os.path.exists(args.output_file):
+        with open(args.output_file, "r", encoding="utf-8") as f:
+            for line in f:
+                finished_ids.add(get_message_id(json.loads(line)))
+        print(f"Resuming stream, {len(finished_ids)} user messages already finished in {args.output_file}")
+
+    def select(qs_id):
+        if qs_id in finished_ids:
+            return False
+        return args.num_shards == 1 or shard_of(qs_id, args.num_shards) == args.shard_index
+
+    iter_messages = iter_TabFact_messages if args.dataset_name == TAB_NAME else iter_wikiTQ_messages
+    message_iter = iter_messages(args, args.start_agent, select=select)
+
+    coordinator = Coordinator(args)
+    with open(args.output_file, "a", encoding="utf-8") as fp:
+        def flush_finished(dataset_index, user_message):
+            # Output is in completion order, dataset_index keeps the original position
+            user_message["dataset_index"] = dataset_index
+            fp.write(json.dumps(user_message, ensure_ascii=False) + "\n")
+            fp.flush()
+
+        coordinator.process_stream(message_iter, args, flush_finished, max_in_flight=args.max_in_flight)
+    report_throughput(coordinator, args)
+    coordinator.llm.close()
 
 
 def main(args):
@@ -16,37 +97,53 @@ def main(args):
     if not os.path.exists(result_folder):
         os.makedirs(result_folder)
 
+    if args.work_queue is not None:
+        run_queue_worker(args)
+        return
+
+    if args.num_shards > 1:
+        if not 0 <= args.shard_index < args.num_shards:
+            raise ValueError(f"shard_index must be in [0, {args.num_shards}), got {args.shard_index}")
+        args.output_file = shard_file_path(args.output_file, args.num_shards, args.shard_index)
+        print(f"Running shard {args.shard_index} of {args.num_shards}, output: {args.output_file}")
+    if args.stream:
+        run_stream(args)
+        return
+    journal_file = args.output_file + ".journal"
+    sidecar_file = args.output_file + ".responses"
     if os.path.exists(args.output_file):
         print(f"Loading previous user_messages from {args.output_file}")
         with open(args.output_file, "r", encoding="utf-8") as f:
             user_messages = [json.loads(line) for line in f]
     else:
-        if args.dataset_name == TAB_NAME:
-            tabfact_df = load_tabfact_dataset(args)
-            user_messages = init_TabFact_messages(tabfact_df, args.start_agent)[: args.head]
-        else:
-            wiki_data = load_wikiTQ_data(args.input_file)
-            wiki_data = preload_wiki_data(args, wiki_data)
-            user_messages = init_wikiTQ_messages(wiki_data, args.start_agent)[: args.head]
+        user_messages = load_user_messages(args, sharded=args.num_shards > 1)
+        # Write the initial state once, later hops only go to the journal
+        compact_journal(args.output_file, journal_file, user_messages)
     
     all_finished = False
     running_round = 0
     coordinator = Coordinator(args)
-    while not all_finished:
-        all_finished, user_messages = coordinator.process(user_messages, args)
-        running_round += 1
-        print(f"Running round {running_round} done!", flush=True)
-        with open(args.output_file, "w", encoding="utf-8") as fp:
-            for user_message in user_messages:
-                fp.write(json.dumps(user_message, ensure_ascii=False) + "\n")
-        print(f"Intermediate result saved after round {running_round}")
-
-    # Dump user messages as a jsonl file, into the output_file
-    with open(
-        args.output_file, "w", encoding="utf-8"
-    ) as fp:  
-        for user_message in user_messages:
-            fp.write(json.dumps(user_message, ensure_ascii=False) + "\n")
+    replayed = replay_journal(journal_file, user_messages, coordinator.agents, args)
+    if replayed > 0:
+        print(f"Replayed {replayed} hops from {journal_file}")
+    coordinator.journal = MessageJournal(journal_file)
+    # Responses that arrived before an interrupted round was journaled are reused, not regenerated
+    coordinator.llm.sidecar = ResponseSidecar(sidecar_file)
+    if args.scheduler == "continuous":
+        user_messages = coordinator.process_continuous(user_messages, args)
+    else:
+        while not all_finished:
+            all_finished, user_messages = coordinator.process(user_messages, args)
+            running_round += 1
+            print(f"Running round {running_round} done!", flush=True)
+            print(f"Intermediate result journaled after round {running_round}")
+
+    # Compact the journal into the final jsonl output_file
+    coordinator.journal.close()
+    compact_journal(args.output_file, journal_file, user_messages)
+    coordinator.llm.sidecar.close()
+    os.remove(sidecar_file)
+    report_throughput(coordinator, args)
     
     coordinator.llm.close()
         
@@ -66,11 +163,81 @@ if __name__ == "__main__":
         "--llm_in_use", type=str, required=True, help="model used to inference"
     )
     parser.add_argument(
-        "--llm_url", type=str, required=False, help=" ", default="http://localhost:9876/v1/"
+        "--llm_url", type=str, required=False, help="OpenAI-compatible endpoint, or a comma-separated list of replicas to balance over", default="http://localhost:9876/v1/"
+    )
+    parser.add_argument(
+        "--tensor_parallel_size", type=int, default=2, help="tensor parallel size of the vLLM server started in api_self_hosted mode"
+    )
+    parser.add_argument(
+        "--keep_vllm", action="store_true", help="leave the vLLM server started in api_self_hosted mode running, the next script reuses it"
+    )
+    parser.add_argument(
+        "--max_model_len", type=int, default=None, help=f"context length of the served model, requests' max_tokens are clamped so prompt plus output fit; default {MAX_MODEL_LEN} for a self-hosted server or offline, no clamping for other API endpoints"
+    )
+    parser.add_argument(
+        "--affinity", type=str, default="none", choices=["none", "message", "table"],
+        help="with several replicas, send every hop of a message or every question on a table to the same replica for prefix caching"
     )
     parser.add_argument(
         "--llm_api_key", type=str, required=False, help=" ", default="None"
     )
+    parser.add_argument(
+        "--llm_cache", type=str, default=None, help="path to an on-disk SQLite cache of LLM responses reused across runs, keyed by model, prompt and sampling parameters"
+    )
+    parser.add_argument(
+        "--llm_cache_max_entries", type=int, default=1000000, help="least recently used responses beyond this many are evicted from --llm_cache"
+    )
+    parser.add_argument(
+        "--llm_record", type=str, default=None, help="directory to record every LLM response and its latency in, for --llm_replay"
+    )
+    parser.add_argument(
+        "--llm_replay", type=str, default=None, help="directory of an --llm_record run whose responses are replayed instead of calling a model"
+    )
+    parser.add_argument(
+        "--llm_replay_latency", action="store_true", help="with --llm_replay, wait the recorded latency of every response"
+    )
+    parser.add_argument(
+        "--initial_concurrency", type=int, default=MAX_CONCURRENT_REQUESTS, help="in-flight API requests at start, adapted from latency and 429/5xx responses"
+    )
+    parser.add_argument(
+        "--min_concurrency", type=int, default=1, help="lower bound of the adaptive concurrency limit"
+    )
+    parser.add_argument(
+        "--max_concurrency", type=int, default=MAX_ADAPTIVE_CONCURRENCY, help="upper bound of the adaptive concurrency limit"
+    )
+    parser.add_argument(
+        "--rpm", type=int, default=None, help="requests per minute budget of the endpoint"
+    )
+    parser.add_argument(
+        "--tpm", type=int, default=None, help="prompt tokens per minute budget of the endpoint, estimated as 4 characters per token"
+    )
+    parser.add_argument(
+        "--max_retries", type=int, default=MAX_REQUEST_RETRIES, help="retries of an API request after connection errors and 408/409/429/5xx responses"
+    )
+    parser.add_argument(
+        "--retry_backoff", type=float, default=RETRY_BACKOFF_SECONDS, help="base of the exponential retry backoff in seconds"
+    )
+    parser.add_argument(
+        "--hedge_percentile", type=float, default=None, help="send a duplicate of requests slower than this latency percentile of recent requests, e.g. 95"
+    )
+    parser.add_argument(
+        "--stream_json", action="store_true", help="stream responses of JSON agents and stop each one once its JSON object is complete (API modes only)"
+    )
+    parser.add_argument(
+        "--dedup_prompts", action="store_true",
+        help="send identical prompts of an agent once per step and share the response, within a round and across rounds"
+    )
+    parser.add_argument(
+        "--guided_decoding", type=str, default="none", choices=["none", "response_format", "guided_json"],
+        help="send each agent's JSON schema as an OpenAI response_format or a vLLM guided_json constraint (API modes only)"
+    )
+    parser.add_argument(
+        "--sampling_profiles", type=str, default=None,
+        help='json file overriding the per-agent sampling profiles (max_tokens, stop, temperature), e.g. {"Checker": {"max_tokens": 512, "temperature": 0}}'
+    )
+    parser.add_argument(
+        "--no_sampling_profiles", action="store_true", help="send requests without per-agent max_tokens, stop or temperature"
+    )
     parser.add_argument(
         "--dataset_name", type=str, required=True, help="which dataset to run", default=WIKI_NAME
     )
@@ -89,6 +256,53 @@ if __name__ == "__main__":
     parser.add_argument(
         "--standard_baseline_variant", type=str, default="zero_shot", help="the type of standard baseline"
     )
+    parser.add_argument(
+        "--scheduler", type=str, default="round", choices=["round", "continuous"],
+        help="round: wait for the whole batch every round; continuous: route each message as soon as its response arrives (API modes only)"
+    )
+    parser.add_argument(
+        "--num_shards", type=int, default=1, help="split the dataset by qs_id into this many shards, merge them with merge_shards.py"
+    )
+    parser.add_argument(
+        "--shard_index", type=int, default=0, help="which shard this process runs, from 0 to num_shards - 1"
+    )
+    parser.add_argument(
+        "--work_queue", type=str, default=None, help="path to a shared SQLite work queue, any number of workers can pull from it"
+    )
+    parser.add_argument(
+        "--worker_id", type=str, default=f"{socket.gethostname()}-{os.getpid()}", help="name of this worker in the work queue"
+    )
+    parser.add_argument(
+        "--lease_size", type=int, default=256, help="number of messages a worker leases for one hop"
+    )
+    parser.add_argument(
+        "--lease_seconds", type=float, default=1800, help="leases older than this are handed to other workers, must exceed one hop of a lease"
+    )
+    parser.add_argument(
+        "--order_policy", type=str, default="dataset", choices=list(ORDER_POLICIES.keys()),
+        help="submission order of each round: dataset, longest_first, shortest_first or closest_to_end"
+    )
+    parser.add_argument(
+        "--prefix_grouping", action="store_true", help="group each round's prompts by agent and table so shared prefixes hit the server's prefix cache"
+    )
+    parser.add_argument(
+        "--throughput_report", type=str, default=None, help="path to save the per-round throughput report as json"
+    )
+    parser.add_argument(
+        "--baseline_report", type=str, default=None,
+        help="throughput report of an earlier run, e.g. without --guided_decoding, to compare invalid format retries against"
+    )
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="read the dataset lazily and append finished messages to output_file in completion order, memory stays bounded by max_in_flight (API modes only)"
+    )
+    parser.add_argument(
+        "--max_in_flight", type=int, default=1024, help="most user messages held in memory at once with --stream"
+    )
+    parser.add_argument(
+        "--agent_timeouts", type=str, default=None,
+        help="per-agent request deadlines in seconds, e.g. Solver=600,Checker=120,Reflector=300; timed out messages are retried next round without spending a reasoning round (API modes only)"
+    )
     args = parser.parse_args()
     # print args
     for key, value in vars(args).items():
@@ -118,6 +118,7 @@ def main(args):
     
     # save memory into a place for retrive and visulize
     print(f"[Done] Finish add all memories, add {len(ms.memories)} memories, evolve {ms.evol_count} times invoving {ms.evol_mem_count} memories")
+    ms.llm.close()
 
 
 if __name__ == "__main__":
@@ -140,6 +141,30 @@ if __name__ == "__main__":
     parser.add_argument(
         "--llm_api_key", type=str, required=False, help=" ", default="None"
     )
+    parser.add_argument(
+        "--llm_cache", type=str, default=None, help="path to an on-disk SQLite cache of LLM responses reused across runs, keyed by model, prompt and sampling parameters"
+    )
+    parser.add_argument(
+        "--llm_cache_max_entries", type=int, default=1000000, help="least recently used responses beyond this many are evicted from --llm_cache"
+    )
+    parser.add_argument(
+        "--llm_record", type=str, default=None, help="directory to record every LLM response and its latency in, for --llm_replay"
+    )
+    parser.add_argument(
+        "--llm_replay", type=str, default=None, help="directory of an --llm_record run whose responses are replayed instead of calling a model"
+    )
+    parser.add_argument(
+        "--llm_replay_latency", action="store_true", help="with --llm_replay, wait the recorded latency of every response"
+    )
+    parser.add_argument(
+        "--tensor_parallel_size", type=int, default=2, help="tensor parallel size of the vLLM server started in api_self_hosted mode"
+    )
+    parser.add_argument(
+        "--keep_vllm", action="store_true", help="leave the vLLM server started in api_self_hosted mode running, the next script reuses it"
+    )
+    parser.add_argument(
+        "--max_model_len", type=int, default=None, help=f"context length of the served model, requests' max_tokens are clamped so prompt plus output fit; default {MAX_MODEL_LEN} for a self-hosted server or offline, no clamping for other API endpoints"
+    )
     parser.add_argument(
         "--head", type=int, default=1000000, help="head of the dataset to run"
     )
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import os
 import json
+import time
 import argparse
 
 from utils import *
@@ -50,11 +51,16 @@ def main(args):
     
     coordinator = Coordinator(args)
 
+    start_time = time.time()
     while not all_finished:
-        all_finished, user_messages, job_done = coordinator.job_process(user_messages, args, str(running_round))
+        all_finished, round_messages, job_done = coordinator.job_process(user_messages, args, str(running_round))
         if not job_done:
-            print("Job not done, waiting longer to fetch results")
-            return
+            if args.poll_interval is None:
+                print("Job not done, waiting longer to fetch results")
+                return
+            time.sleep(args.poll_interval)
+            continue
+        user_messages = round_messages
         with open(args.output_file, "w", encoding="utf-8") as fp:
             for user_message in user_messages:
                 fp.write(json.dumps(user_message, ensure_ascii=False) + "\n")
@@ -63,6 +69,7 @@ def main(args):
         running_round += 1
         with open(args.processed_jobs_file_path, "w") as f:
             json.dump({'running_round': running_round}, f)
+    print(f"All rounds done in {time.time() - start_time:.1f}s")
 
         
 
@@ -116,6 +123,30 @@ if __name__ == "__main__":
     parser.add_argument(
         "--processed_jobs_file_path", type=str, default="./processed_jobs.jsonl", help="path to save processed jobs"
     )
+    parser.add_argument(
+        "--oai_emulator", type=str, default=None, help="directory of a local emulator of the OpenAI Files and Batches API, used instead of the service"
+    )
+    parser.add_argument(
+        "--oai_emulator_time_scale", type=float, default=1.0, help="multiplies the emulated batch durations, 0 completes every batch at once"
+    )
+    parser.add_argument(
+        "--oai_batch_max_requests", type=int, default=OAI_BATCH_MAX_REQUESTS, help="most requests in one batch, larger rounds are split"
+    )
+    parser.add_argument(
+        "--oai_batch_max_bytes", type=int, default=OAI_BATCH_MAX_BYTES, help="largest batch input file in bytes, larger rounds are split"
+    )
+    parser.add_argument(
+        "--oai_batch_workers", type=int, default=OAI_BATCH_WORKERS, help="sub-batches uploaded, polled and downloaded at once"
+    )
+    parser.add_argument(
+        "--oai_batch_max_retries", type=int, default=OAI_BATCH_MAX_RETRIES, help="follow-up batches of a round's failed requests before their messages are requeued"
+    )
+    parser.add_argument(
+        "--oai_emulator_error_rate", type=float, default=0.0, help="fraction of emulated batch requests that fail and go to the error file"
+    )
+    parser.add_argument(
+        "--poll_interval", type=float, default=None, help="seconds between checks of an unfinished job, by default the script exits and is run again later"
+    )
     args = parser.parse_args()
     # print args
     for key, value in vars(args).items():
@@ -18,6 +18,15 @@ class BaseAgent(metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def process_response(self):
         pass   
+
+    def num_responses(self, message):
+        # Responses of this agent already processed for message, see dedup.dedup_key
+        return 0
+
+    def count_invalid_format(self, message):
+        # Every response that fails parse_json costs the message another round of this agent
+        counts = message.setdefault('invalid_format_rounds', {})
+        counts[self.name] = counts.get(self.name, 0) + 1
     
 class Solver(BaseAgent):
     """
@@ -26,6 +35,9 @@ class Solver(BaseAgent):
     
     def __init__(self, available_agents: list):
         super().__init__(available_agents)
+
+    def num_responses(self, message):
+        return sum(len(result['inner_result_list']) for result in message['reasoner_result'])
         
     def prepare_prompt(self, message, args):
         # first_round_in_loop will affect the table that give to the LLM
@@ -105,6 +117,7 @@ class Solver(BaseAgent):
                             }
             message['current_table'] = reasoner_result.get("intermediate_table","")
         else:
+            self.count_invalid_format(message)
             answer = "INVALID_FORMAT"
             new_inner_dict ={
             'inner_round': message['inner_reasoner_round'],
@@ -191,6 +204,9 @@ class Checker(BaseAgent):
     
     def __init__(self, available_agents: list):
         super().__init__(available_agents)
+
+    def num_responses(self, message):
+        return len(message['checker_result'])
         
     def prepare_prompt(self, message, args):
         origin_table = message.get('origin_table')
@@ -248,6 +264,7 @@ class Checker(BaseAgent):
         checker_result, is_format_correct = parse_json(llm_response)
 
         if not is_format_correct:
+            self.count_invalid_format(message)
             checker_score = -100
             message['checker_result'].append({
                 'round': message['checker_round'],
@@ -299,6 +316,9 @@ class Reflector(BaseAgent):
     
     def __init__(self, available_agents: list):
         super().__init__(available_agents)
+
+    def num_responses(self, message):
+        return len(message['reflector_result'])
         
     def prepare_prompt(self, message, args):
         origin_table = message.get('origin_table')
@@ -348,6 +368,7 @@ class Reflector(BaseAgent):
                 'improvement_plan': reasoner_result.get("improvement_plan", ""),
             })
         else:
+            self.count_invalid_format(message)
             message['reflector_result'].append({
                 'round': message['reflector_round'],
                 'diagnosis': llm_response,
@@ -390,6 +411,9 @@ class Baseline(BaseAgent):
     
     def __init__(self, available_agents: list):
         super().__init__(available_agents)
+
+    def num_responses(self, message):
+        return len(message['baseline_result'])
     
     def prepare_prompt(self, message, args):
         origin_table = message.get('origin_table')
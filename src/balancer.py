@@ -0,0 +1,108 @@
+import asyncio
+import hashlib
+from openai import APIConnectionError
+from const import *
+
+
+def is_connection_error(error):
+    """Errors that say more about the replica than about the request."""
+    return isinstance(error, APIConnectionError) or getattr(error, "status_code", None) in [502, 503, 504]
+
+
+def rendezvous_score(key, url):
+    return hashlib.sha1(f"{key}|{url}".encode("utf-8")).hexdigest()
+
+
+class Replica(object):
+    """One OpenAI-compatible endpoint and its client."""
+    def __init__(self, url, client):
+        self.url = url
+        self.client = client
+        self.outstanding = 0
+        self.healthy = True
+        self.requests = 0
+        self.failures = 0
+
+
+class EndpointBalancer(object):
+    """
+    Client-side balancing over several vLLM replicas.
+
+    Requests go to the healthy replica with the fewest outstanding requests.
+    Requests with an affinity key, e.g. a message id or a table id, go to the
+    replica chosen for that key by rendezvous hashing, so every hop of a message
+    or every question on a table reaches the same prefix cache. A replica with
+    more than AFFINITY_LOAD_FACTOR times the average load passes its keys on to
+    the next replica in their rendezvous order. Replicas that fail a request in
+    transit are skipped until their /v1/models health probe succeeds again.
+    """
+    def __init__(self, urls, make_client, probe_interval=HEALTH_PROBE_INTERVAL):
+        self.replicas = [Replica(url, make_client(url)) for url in urls]
+        self.probe_interval = probe_interval
+        self.probe_task = None
+
+    def candidates(self):
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        # With every replica down, keep trying them all rather than failing outright
+        return healthy if healthy else self.replicas
+
+    def pick(self, affinity_key=None):
+        replicas = self.candidates()
+        if affinity_key is None:
+            # Ties, e.g. between idle replicas, go to the one that served fewer requests
+            return min(replicas, key=lambda replica: (replica.outstanding, replica.requests))
+        ranked = sorted(replicas, key=lambda replica: rendezvous_score(affinity_key, replica.url), reverse=True)
+        average = sum(replica.outstanding for replica in replicas) / len(replicas)
+        for replica in ranked:
+            if replica.outstanding <= AFFINITY_LOAD_FACTOR * (average + 1):
+                return replica
+        return ranked[0]
+
+    async def request(self, affinity_key, create):
+        """Run create(client) on a picked replica and keep its load and health up to date."""
+        self.ensure_probing()
+        replica = self.pick(affinity_key)
+        replica.outstanding += 1
+        replica.requests += 1
+        try:
+            return await create(replica.client)
+        except Exception as e:
+            if is_connection_error(e):
+                replica.failures += 1
+                if replica.healthy:
+                    print(f"Replica {replica.url} failed a request, skipping it until it passes a health probe")
+                replica.healthy = False
+            raise
+        finally:
+            replica.outstanding -= 1
+
+    def ensure_probing(self):
+        if self.probe_task is None or self.probe_task.done():
+            self.probe_task = asyncio.ensure_future(self.probe_forever())
+
+    async def probe(self, replica):
+        try:
+            await asyncio.wait_for(replica.client.models.list(), timeout=HEALTH_PROBE_TIMEOUT)
+            healthy = True
+        except Exception:
+            healthy = False
+        if healthy != replica.healthy:
+            print(f"Replica {replica.url} is {'healthy again' if healthy else 'failing health probes'}")
+        replica.healthy = healthy
+
+    async def probe_forever(self):
+        while True:
+            await asyncio.gather(*[self.probe(replica) for replica in self.replicas])
+            await asyncio.sleep(self.probe_interval)
+
+    def stats(self):
+        return {
+            replica.url: {"requests": replica.requests, "failures": replica.failures, "healthy": replica.healthy}
+            for replica in self.replicas
+        }
+
+    async def close(self):
+        if self.probe_task is not None:
+            self.probe_task.cancel()
+        for replica in self.replicas:
+            await replica.client.close()
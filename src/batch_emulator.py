@@ -0,0 +1,304 @@
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+from mock_responder import MockResponder
+from rate_limiter import estimate_tokens
+
+
+def to_namespace(value):
+    """OpenAI SDK-like object of a JSON value, attributes instead of keys."""
+    if isinstance(value, dict):
+        return SimpleNamespace(**{key: to_namespace(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [to_namespace(item) for item in value]
+    return value
+
+
+class EmulatedFileContent(object):
+    """
+    What files.content returns, and files.with_streaming_response.content
+    opens: the file's bytes, its text and its lines, read from disk on demand.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    @property
+    def content(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def iter_bytes(self, chunk_size=1024 * 1024):
+        with open(self.path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                yield chunk
+
+    def iter_lines(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                yield line.rstrip("\n")
+
+    def stream_to_file(self, file):
+        with open(file, "wb") as f:
+            for chunk in self.iter_bytes():
+                f.write(chunk)
+
+    write_to_file = stream_to_file
+
+
+class EmulatedStreamingFiles(object):
+    def __init__(self, files):
+        self.files = files
+
+    def content(self, file_id):
+        return self.files.content(file_id)
+
+
+class EmulatedFiles(object):
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.with_streaming_response = EmulatedStreamingFiles(self)
+
+    def create(self, file, purpose):
+        if hasattr(file, "read"):
+            content = file.read()
+            filename = os.path.basename(getattr(file, "name", "upload.jsonl"))
+        else:
+            with open(file, "rb") as f:
+                content = f.read()
+            filename = os.path.basename(file)
+        return to_namespace(self.emulator.save_file(content, filename, purpose))
+
+    def retrieve(self, file_id):
+        return to_namespace(self.emulator.load_json("files", file_id))
+
+    def content(self, file_id):
+        self.emulator.load_json("files", file_id)
+        return EmulatedFileContent(self.emulator.file_path(file_id))
+
+
+class EmulatedBatches(object):
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    def create(self, input_file_id, endpoint, completion_window, metadata=None):
+        return to_namespace(self.emulator.create_batch(input_file_id, endpoint, completion_window, metadata))
+
+    def retrieve(self, batch_id):
+        return to_namespace(self.emulator.advance_batch(batch_id))
+
+
+class OpenAIBatchEmulator(object):
+    """
+    Local stand-in for the Files and Batches API of an OpenAI client, for
+    running and timing the oai_batch workflow without the service.
+
+    Files and batches are saved under directory, so a later run_openai_batch.py
+    run fetches the jobs an earlier one submitted, as with the real service. A
+    batch is validating for validating_seconds, in_progress for
+    seconds_per_request per request and finalizing for finalizing_seconds,
+    all multiplied by time_scale (0 completes every batch at once) and
+    measured with clock. Once it completes, its output file has a chat
+    completion from responder (anything with a respond(messages) method,
+    MockResponder by default) for every request, in a shuffled order unless
+    shuffle_output is False, since the service does not keep the input order
+    either. With error_rate a request fails with a server error and goes to
+    the batch's error file instead. An input file with malformed lines or repeated custom_ids fails
+    validation like it would upstream. Batches advance independently, so
+    concurrent polls of different batches do not wait for each other.
+    """
+    def __init__(self, directory, responder=None, time_scale=1.0, validating_seconds=2.0, seconds_per_request=0.05,
+                 finalizing_seconds=2.0, clock=time.time, model="emulated-model", shuffle_output=True,
+                 error_rate=0.0):
+        self.directory = directory
+        self.responder = responder if responder is not None else MockResponder()
+        self.time_scale = time_scale
+        self.validating_seconds = validating_seconds
+        self.seconds_per_request = seconds_per_request
+        self.finalizing_seconds = finalizing_seconds
+        self.clock = clock
+        self.model = model
+        self.shuffle_output = shuffle_output
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.batch_locks = {}
+        for kind in ["files", "batches"]:
+            os.makedirs(os.path.join(directory, kind), exist_ok=True)
+        self.files = EmulatedFiles(self)
+        self.batches = EmulatedBatches(self)
+        print(f"Emulating the OpenAI Files and Batches API in {directory}, time scale {time_scale}")
+
+    def file_path(self, file_id):
+        return os.path.join(self.directory, "files", f"{file_id}.jsonl")
+
+    def json_path(self, kind, object_id):
+        return os.path.join(self.directory, kind, f"{object_id}.json")
+
+    def load_json(self, kind, object_id):
+        path = self.json_path(kind, object_id)
+        if not os.path.exists(path):
+            raise KeyError(f"No {kind[:-1]} {object_id} in {self.directory}")
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_json(self, kind, payload):
+        path = self.json_path(kind, payload["id"])
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def save_file(self, content, filename, purpose):
+        file_id = f"file-{uuid.uuid4().hex}"
+        with open(self.file_path(file_id), "wb") as f:
+            f.write(content)
+        payload = {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(self.clock()),
+                   "filename": filename, "purpose": purpose, "status": "processed"}
+        self.save_json("files", payload)
+        return payload
+
+    def create_batch(self, input_file_id, endpoint, completion_window, metadata=None):
+        self.load_json("files", input_file_id)
+        with open(self.file_path(input_file_id), "r", encoding="utf-8") as f:
+            total = sum(1 for line in f if line.strip())
+        payload = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            # created_at is whole seconds, the phases are timed from this float so small time scales work
+            "created_time": self.clock(),
+            "created_at": int(self.clock()),
+            "in_progress_at": None,
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "request_counts": {"total": total, "completed": 0, "failed": 0},
+            "metadata": metadata,
+        }
+        self.save_json("batches", payload)
+        return payload
+
+    def phase_ends(self, total):
+        """Seconds after creation at which validating, in_progress and finalizing end."""
+        validated = self.validating_seconds * self.time_scale
+        processed = validated + self.seconds_per_request * total * self.time_scale
+        return validated, processed, processed + self.finalizing_seconds * self.time_scale
+
+    def advance_batch(self, batch_id):
+        """The batch's status at the current clock, running the requests once it completes."""
+        with self.lock:
+            batch_lock = self.batch_locks.setdefault(batch_id, threading.Lock())
+        with batch_lock:
+            batch = self.load_json("batches", batch_id)
+            if batch["status"] in ["completed", "failed"]:
+                return batch
+            elapsed = self.clock() - batch["created_time"]
+            validated, processed, finalized = self.phase_ends(batch["request_counts"]["total"])
+            if elapsed >= validated and batch["status"] == "validating":
+                errors = self.validate(batch)
+                if errors:
+                    batch.update(status="failed", failed_at=int(self.clock()), errors={"object": "list", "data": errors})
+                    self.save_json("batches", batch)
+                    return batch
+                batch.update(status="in_progress", in_progress_at=int(self.clock()))
+            if elapsed >= processed and batch["status"] == "in_progress":
+                batch.update(status="finalizing", finalizing_at=int(self.clock()))
+            if elapsed >= finalized and batch["status"] == "finalizing":
+                self.complete(batch)
+            self.save_json("batches", batch)
+            return batch
+
+    def read_requests(self, batch):
+        with open(self.file_path(batch["input_file_id"]), "r", encoding="utf-8") as f:
+            return [line for line in f if line.strip()]
+
+    def validate(self, batch):
+        errors = []
+        custom_ids = set()
+        for line_number, line in enumerate(self.read_requests(batch), start=1):
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError:
+                errors.append({"code": "invalid_json_line", "message": "This line is not parseable as valid JSON.", "line": line_number})
+                continue
+            if request.get("url") != batch["endpoint"]:
+                errors.append({"code": "mismatched_endpoint", "message": f"The url of this request does not match {batch['endpoint']}.", "line": line_number})
+            elif request.get("custom_id") in custom_ids:
+                errors.append({"code": "duplicate_custom_id", "message": "The custom_id of this request is a duplicate.", "line": line_number})
+            custom_ids.add(request.get("custom_id"))
+        return errors
+
+    def complete(self, batch):
+        rng = random.Random(batch["id"])
+        lines, errors = [], []
+        for line in self.read_requests(batch):
+            request = json.loads(line)
+            if rng.random() < self.error_rate:
+                errors.append(json.dumps(self.fail(request), ensure_ascii=False))
+            else:
+                lines.append(json.dumps(self.respond(request), ensure_ascii=False))
+        if self.shuffle_output:
+            rng.shuffle(lines)
+        batch["request_counts"].update(completed=len(lines), failed=len(errors))
+        if len(lines) > 0:
+            output = self.save_file(("\n".join(lines) + "\n").encode("utf-8"), f"{batch['id']}_output.jsonl", "batch_output")
+            batch["output_file_id"] = output["id"]
+        if len(errors) > 0:
+            error = self.save_file(("\n".join(errors) + "\n").encode("utf-8"), f"{batch['id']}_error.jsonl", "batch_output")
+            batch["error_file_id"] = error["id"]
+        batch.update(status="completed", completed_at=int(self.clock()))
+
+    def fail(self, request):
+        return {
+            "id": f"batch_req_{uuid.uuid4().hex}",
+            "custom_id": request["custom_id"],
+            "response": {
+                "status_code": 500,
+                "request_id": uuid.uuid4().hex,
+                "body": {"error": {"message": "The server had an error while processing your request.",
+                                   "type": "server_error", "code": "server_error"}},
+            },
+            "error": None,
+        }
+
+    def respond(self, request):
+        messages = request["body"].get("messages", [])
+        content = self.responder.respond(messages)
+        prompt_tokens = estimate_tokens(messages)
+        completion_tokens = estimate_tokens(content)
+        return {
+            "id": f"batch_req_{uuid.uuid4().hex}",
+            "custom_id": request["custom_id"],
+            "response": {
+                "status_code": 200,
+                "request_id": uuid.uuid4().hex,
+                "body": {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(self.clock()),
+                    "model": request["body"].get("model", self.model),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                              "total_tokens": prompt_tokens + completion_tokens},
+                },
+            },
+            "error": None,
+        }
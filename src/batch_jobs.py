@@ -0,0 +1,112 @@
+import json
+import os
+import pickle
+
+
+def custom_id(prompt_id):
+    return f"request-{prompt_id}"
+
+
+def split_requests(lines, max_requests, max_bytes):
+    """
+    Consecutive sub-batches of JSONL request lines with at most max_requests
+    lines and max_bytes bytes each. A line longer than max_bytes gets a
+    sub-batch of its own.
+    """
+    shards, current, size = [], [], 0
+    for line in lines:
+        line_bytes = len(line.encode("utf-8")) + 1
+        if current and (len(current) >= max_requests or size + line_bytes > max_bytes):
+            shards.append(current)
+            current, size = [], 0
+        current.append(line)
+        size += line_bytes
+    if current:
+        shards.append(current)
+    return shards
+
+
+def manifest_path(job_dir, job_name):
+    return os.path.join(job_dir, f"{job_name}_manifest.json")
+
+
+def write_manifest(job_dir, manifest):
+    path = manifest_path(job_dir, manifest["job_name"])
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def read_manifest(job_dir, job_name):
+    """
+    The receipt manifest of a round: its request count and, for every
+    sub-batch, the input file, batch id and output file (paths relative to
+    job_dir). The single-batch pickle receipt of an older run is converted to
+    a one-shard manifest. None if the round was not submitted.
+    """
+    path = manifest_path(job_dir, job_name)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    legacy_path = os.path.join(job_dir, f"{job_name}_reciept.pkl")
+    if not os.path.exists(legacy_path):
+        return None
+    with open(legacy_path, "rb") as f:
+        reciept = pickle.load(f)
+    input_file = f"{job_name}.jsonl"
+    if os.path.exists(os.path.join(job_dir, input_file)):
+        with open(os.path.join(job_dir, input_file), "r", encoding="utf-8") as f:
+            requests = sum(1 for line in f if line.strip())
+    else:
+        requests = reciept.request_counts.total
+    manifest = {
+        "job_name": job_name,
+        "requests": requests,
+        "shards": [{
+            "index": 0,
+            "input_file": input_file,
+            "requests": requests,
+            "input_file_id": reciept.input_file_id,
+            "batch_id": reciept.id,
+            # Where the older run saved a fetched round
+            "output_file": f"{job_name}_batch_output.jsonl",
+        }],
+    }
+    write_manifest(job_dir, manifest)
+    print(f"Converted the pickle receipt of job {job_name} to {manifest_path(job_dir, job_name)}")
+    return manifest
+
+
+def read_output_contents(path):
+    """
+    custom_id to response text of the successful requests in a batch output
+    file, read line by line. A response without text (content null, as in a
+    refusal) is left out, so it is retried like a failed request.
+    """
+    contents = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            content = response["body"]["choices"][0]["message"].get("content")
+            if content is not None:
+                contents[result["custom_id"]] = content.strip()
+    return contents
+
+
+def read_error_reasons(path):
+    """custom_id to error code of the requests in a batch error file."""
+    reasons = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get("response") or {}
+            error = result.get("error") or (response.get("body") or {}).get("error") or {}
+            reasons[result.get("custom_id")] = error.get("code") or error.get("type") or f"status {response.get('status_code')}"
+    return reasons
@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import threading
+from journal import read_log_entries
+
+CASSETTE_FILE = "cassette.jsonl"
+# Request options that are part of a cassette key, a recording replays with any endpoint or model.
+# key tells apart identical prompts of different messages, whose requests finish in any order.
+CASSETTE_OPTION_FIELDS = ["key", "sampling", "schema", "cache_salt"]
+
+
+def cassette_key(prompt, options=None):
+    options = options or {}
+    payload = {"prompt": prompt, "options": {name: options.get(name) for name in CASSETTE_OPTION_FIELDS}}
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class LLMCassette(object):
+    """
+    Recorded LLM responses for runs without a model.
+
+    In "record" mode every request's response (or failure) and latency is
+    appended to <directory>/cassette.jsonl. In "replay" mode the same requests
+    are answered from that file, so Coordinator, agent and memory system runs
+    can be profiled and regression-tested on a CPU-only box. Repeated requests
+    with the same cassette_key are numbered in submission order, which must be
+    deterministic, see LLMWrapper.call_llm_api_async. A request missing from
+    the cassette means the run diverged from the recording and raises a KeyError.
+    """
+    def __init__(self, directory, mode):
+        if mode not in ["record", "replay"]:
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.directory = directory
+        self.mode = mode
+        self.path = os.path.join(directory, CASSETTE_FILE)
+        self.entries = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        if mode == "replay" and not os.path.exists(self.path):
+            raise FileNotFoundError(f"No cassette to replay at {self.path}")
+        for entry in read_log_entries(self.path):
+            self.entries[(entry["key"], entry["index"])] = entry
+            if mode == "record":
+                # Append after an earlier, e.g. interrupted, recording
+                self.counters[entry["key"]] = max(self.counters.get(entry["key"], 0), entry["index"] + 1)
+        self.fp = None
+        if mode == "record":
+            os.makedirs(directory, exist_ok=True)
+            self.fp = open(self.path, "a", encoding="utf-8")
+        print(f"LLM cassette {mode} at {self.path}, {len(self.entries)} recorded responses")
+
+    @property
+    def recording(self):
+        return self.mode == "record"
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    def next_slot(self, prompt, options=None):
+        """(key, index) of a new request, taken when the request is submitted so the order is deterministic."""
+        key = cassette_key(prompt, options)
+        with self.lock:
+            index = self.counters.get(key, 0)
+            self.counters[key] = index + 1
+        return key, index
+
+    def record(self, slot, response, latency, failure=None):
+        """Save a response, None for a request without usable output, or a failure reason."""
+        entry = {"key": slot[0], "index": slot[1], "response": response, "failure": failure, "latency": round(latency, 4)}
+        with self.lock:
+            self.fp.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.fp.flush()
+
+    def play(self, slot):
+        if slot not in self.entries:
+            raise KeyError(f"Request {slot[0]} #{slot[1]} is not in the cassette at {self.path}, the run diverged from the recording")
+        return self.entries[slot]
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
@@ -8,6 +8,28 @@ MAX_REFLECTOR_ROUND = 5
 WIKI_CHECKER_POINTS = 6
 TAB_CHECKER_POINTS = 1
 
+MAX_CONCURRENT_REQUESTS = 16 # Initial concurrency limit of the AdaptiveLimiter
+MAX_ADAPTIVE_CONCURRENCY = 256
+MAX_STRAGGLER_REQUEUES = 3
+MAX_REQUEST_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 1.0
+MAX_RETRY_BACKOFF = 60.0
+HEDGE_WINDOW = 200 # Recent request latencies used for the hedging percentile
+HEDGE_MIN_SAMPLES = 20
+HEALTH_PROBE_INTERVAL = 30 # Seconds between /v1/models probes of every replica
+HEALTH_PROBE_TIMEOUT = 5
+AFFINITY_LOAD_FACTOR = 2.0 # A replica above this times the average load gives up its affinity keys
+VLLM_PORT = 9876
+VLLM_READY_TIMEOUT = 60 * 15 # Seconds to wait for a new server to load the model
+VLLM_MAX_POLL_INTERVAL = 5
+STREAM_TABLE_CACHE_SIZE = 256
+DEDUP_MEMO_SIZE = 20000 # Responses remembered for cross-round prompt deduplication
+OAI_BATCH_MAX_REQUESTS = 50000 # Per-batch limits of the OpenAI Batch API
+OAI_BATCH_MAX_BYTES = 190 * 1024 * 1024 # Below the 200 MB input file limit
+OAI_BATCH_WORKERS = 8 # Sub-batches uploaded, polled and downloaded at once
+OAI_BATCH_MAX_RETRIES = 2 # Follow-up batches of a round's failed requests
+OAI_BATCH_FINAL_STATUS = ["completed", "failed", "expired", "cancelled"]
+
 CHECKER_NAME = 'Checker'
 END_NAME = 'End'
 REASONER_NAME = 'Solver'
@@ -15,6 +37,25 @@ BASELINE_NAME = 'Baseline'
 REFLECTOR_NAME = 'Reflector'
 RA_NAME ='Result_Analyze'
 
+# Agents whose responses are parsed with parse_json, everything after the JSON object is ignored
+JSON_RESPONSE_AGENTS = [REASONER_NAME, CHECKER_NAME, REFLECTOR_NAME, RA_NAME]
+
+# Per-agent generation limits, passed to the server with every request. None keeps the model default.
+# Reasoning models get REASONING_MAX_TOKENS_FACTOR times the budget for their thinking. max_tokens is
+# clamped to what the prompt leaves of max_model_len on a self-hosted server, offline, or with --max_model_len.
+AGENT_SAMPLING_PROFILES = {
+    # The Solver returns the whole intermediate table, a fixed cap would cut large tables off
+    REASONER_NAME: {"max_tokens": None},
+    CHECKER_NAME: {"max_tokens": 1024},
+    REFLECTOR_NAME: {"max_tokens": 1024},
+    BASELINE_NAME: {"max_tokens": 2048},
+    RA_NAME: {"max_tokens": 2048},
+}
+REASONING_MAX_TOKENS_FACTOR = 4
+MAX_MODEL_LEN = 16384 # Context length of the vLLM server and the offline model, prompt plus max_tokens must fit
+PROMPT_TOKENS_PER_MESSAGE = 8 # Chat template tokens around every message, counted when max_tokens is clamped
+SAMPLING_FIELDS = ["temperature", "top_p", "top_k", "max_tokens", "repetition_penalty", "stop"]
+
 AGENT_NAME_MAP = {
     'REASONER_NAME': REASONER_NAME,
     'BASELINE_NAME': BASELINE_NAME,
@@ -949,6 +990,89 @@ DATASET_PROMPTS = {
 }
 
 
+# JSON schemas of the agents' [Output Format], sent as a structured output / guided decoding
+# constraint with --guided_decoding so responses always pass parse_json
+solver_json_schema = {
+    "type": "object",
+    "properties": {
+        "thought": {"type": "string"},
+        "action": {"type": "string"},
+        "intermediate_table": {"type": "string"},
+        "answer": {"type": "string"},
+    },
+    "required": ["thought", "action", "intermediate_table", "answer"],
+}
+
+reflector_json_schema = {
+    "type": "object",
+    "properties": {
+        "diagnosis": {"type": "string"},
+        "improvement_plan": {"type": "string"},
+    },
+    "required": ["diagnosis", "improvement_plan"],
+}
+
+checker_aspect_json_schema = {
+    "type": "object",
+    "properties": {
+        "score": {"type": "integer"},
+        "comments": {"type": "string"},
+    },
+    "required": ["score", "comments"],
+}
+
+wiki_checker_json_schema = {
+    "type": "object",
+    "properties": {
+        "feedback": {
+            "type": "object",
+            "properties": {
+                "answer_type_checking": checker_aspect_json_schema,
+                "format_validation": checker_aspect_json_schema,
+                "logical_consistency": checker_aspect_json_schema,
+                "summary": {
+                    "type": "object",
+                    "properties": {
+                        "total_score": {"type": "integer"},
+                        "final_comments": {"type": "string"},
+                    },
+                    "required": ["total_score", "final_comments"],
+                },
+            },
+            "required": ["answer_type_checking", "format_validation", "logical_consistency", "summary"],
+        }
+    },
+    "required": ["feedback"],
+}
+
+tabfact_checker_json_schema = {
+    "type": "object",
+    "properties": {
+        "feedback": {
+            "type": "object",
+            "properties": {
+                "answer_type_checking": checker_aspect_json_schema,
+            },
+            "required": ["answer_type_checking"],
+        }
+    },
+    "required": ["feedback"],
+}
+
+DATASET_JSON_SCHEMAS = {
+    WIKI_NAME: {
+        REASONER_NAME: solver_json_schema,
+        CHECKER_NAME: wiki_checker_json_schema,
+        REFLECTOR_NAME: reflector_json_schema,
+    },
+    TAB_NAME: {
+        REASONER_NAME: solver_json_schema,
+        CHECKER_NAME: tabfact_checker_json_schema,
+        REFLECTOR_NAME: reflector_json_schema,
+    }
+}
+
+
 final_message_example="""
 { "qs_id": 'ns-0',
   "query": 'how long did grand blanc high school participate for?',
@@ -1,7 +1,14 @@
 from agents import *
 from const import *
-from llm import LLMWrapper
+from llm import LLMWrapper, TransportFailure
+from scheduling import *
+from dedup import PromptDeduplicator, dedup_key
+from vllm_server import is_reasoning_model
+import asyncio
+import json
+import time
 import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
 AGENT_CLASS_MAP = {
     'Solver': Solver,
@@ -12,51 +19,375 @@ AGENT_CLASS_MAP = {
 }
 
 
+def load_sampling_profiles(args):
+    """AGENT_SAMPLING_PROFILES, overridden per agent by the --sampling_profiles JSON file."""
+    if getattr(args, "no_sampling_profiles", False):
+        return {}
+    profiles = {name: dict(profile) for name, profile in AGENT_SAMPLING_PROFILES.items()}
+    for profile in profiles.values():
+        if is_reasoning_model(args.llm_in_use) and profile.get('max_tokens') is not None:
+            profile['max_tokens'] *= REASONING_MAX_TOKENS_FACTOR
+    path = getattr(args, "sampling_profiles", None)
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            overrides = json.load(f)
+        for name, override in overrides.items():
+            name = AGENT_NAME_MAP.get(name.strip().upper(), name.strip())
+            if name not in AGENT_CLASS_MAP:
+                raise ValueError(f"Unknown agent name in sampling profiles: {name}. Available keys: {AGENT_CLASS_MAP.keys()}")
+            profiles.setdefault(name, {}).update(override)
+    return profiles
+
+
+def parse_agent_timeouts(spec):
+    """Parse "Solver=600,Checker=120" (agent or *_NAME keys) into {agent name: seconds}."""
+    timeouts = {}
+    if not spec:
+        return timeouts
+    for item in spec.split(','):
+        name, seconds = item.split('=')
+        name = AGENT_NAME_MAP.get(name.strip().upper(), name.strip())
+        if name not in AGENT_CLASS_MAP:
+            raise ValueError(f"Unknown agent name in timeouts: {name}. Available keys: {AGENT_CLASS_MAP.keys()}")
+        timeouts[name] = float(seconds)
+    return timeouts
+
+
 class Coordinator(object):
     def __init__(self, args):
-        self.llm = LLMWrapper(args)
-        
+        # Checked before the LLMWrapper starts or attaches to a server, or loads the offline model
+        self.guided_decoding = getattr(args, "guided_decoding", "none")
+        if self.guided_decoding != "none" and args.inference_mode not in ["api", "api_self_hosted"]:
+            raise ValueError(f"Guided decoding requires an API inference mode, got {args.inference_mode}")
         selected_agent_vars = [x.strip().upper() for x in args.available_agent.split(',')]
         for name in selected_agent_vars:
             if name not in AGENT_NAME_MAP:
                 raise ValueError(f"Unknown agent name: {name}. Available keys: {AGENT_NAME_MAP.keys()}")
 
         selected_agent_names = [AGENT_NAME_MAP[name.strip()] for name in selected_agent_vars]
+        # The agents' system prompts are warmed into the self-hosted server's prefix cache
+        dataset_prompts = DATASET_PROMPTS.get(args.dataset_name, {})
+        self.llm = LLMWrapper(args, warmup_prompts=[dataset_prompts[name]['system_prompt'] for name in selected_agent_names if name in dataset_prompts])
         self.agents = {name: AGENT_CLASS_MAP[name](available_agents=selected_agent_names) for name in selected_agent_names}
+        self.journal = None # Optional MessageJournal that records every hop
+
+        # Per-agent work queues over the indexed message list. Only the indices
+        # of active messages are kept, so a round costs O(active), not O(dataset).
+        self.queues = {name: {} for name in AGENT_CLASS_MAP}
+        self.indexed_messages = None
+
+        # Submission order of each round's prompts, see scheduling.ORDER_POLICIES
+        self.order_policy = getattr(args, "order_policy", "dataset")
+        if self.order_policy not in ORDER_POLICIES:
+            raise ValueError(f"Unknown order policy: {self.order_policy}. Available keys: {ORDER_POLICIES.keys()}")
+        # Group each round by (agent, table) so shared prefixes stay hot in the server's KV cache
+        self.prefix_grouping = getattr(args, "prefix_grouping", False)
+        self.report = ThroughputReport(self.order_policy, self.prefix_grouping)
+
+        # Per-agent request deadlines, a timed out message keeps its hop for the next round
+        self.agent_timeouts = parse_agent_timeouts(getattr(args, "agent_timeouts", None))
+        self.stragglers = 0
+        self.straggler_time = 0.0
+        self.transport_errors = 0
+        # Replica affinity when llm_url lists several endpoints: none, message or table
+        self.affinity = getattr(args, "affinity", "none")
+        # Per-agent max_tokens, stop and temperature, sent with every request
+        self.sampling_profiles = load_sampling_profiles(args)
+        # JSON schemas sent as decoding constraints, and the parse failures they should prevent
+        self.json_schemas = DATASET_JSON_SCHEMAS.get(args.dataset_name, {}) if self.guided_decoding != "none" else {}
+        self.agent_hops = {}
+        self.invalid_formats = {}
+        # Identical prompts share one request, within a round and across rounds
+        self.dedup = PromptDeduplicator() if getattr(args, "dedup_prompts", False) else None
+
+    def order_active(self, user_messages):
+        active_user_messages = ORDER_POLICIES[self.order_policy](user_messages, self.active_indices(user_messages))
+        if self.prefix_grouping:
+            active_user_messages = group_by_prefix(user_messages, active_user_messages)
+        return active_user_messages
+
+    def index_messages(self, user_messages):
+        """Rebuild the work queues with one full scan of user_messages."""
+        self.queues = {name: {} for name in AGENT_CLASS_MAP}
+        for i, user_message in enumerate(user_messages):
+            if user_message['send_to'] != END_NAME:
+                self.queues[user_message['send_to']][i] = None
+        self.indexed_messages = user_messages
+
+    def active_indices(self, user_messages):
+        """Indices of all unfinished messages, in dataset order."""
+        if self.indexed_messages is not user_messages:
+            self.index_messages(user_messages)
+        return sorted(i for queue in self.queues.values() for i in queue)
 
     def prepare_batch_prompt(self, user_messages, args):
         print("Preparing batch prompt")
         prompts = []
-        active_user_messages = []
-        for i,user_message in tqdm.tqdm(enumerate(user_messages),total=len(user_messages)):
-            if user_message['send_to'] == END_NAME:
-                continue
-            
+        active_user_messages = self.order_active(user_messages)
+        for i in tqdm.tqdm(active_user_messages):
+            user_message = user_messages[i]
             prompts.append(self.llm.format_prompt(**self.agents[user_message['send_to']].prepare_prompt(user_message, args)))
-            active_user_messages.append(i)
         print("Remaining active user messages: ", len(active_user_messages))
         return active_user_messages, prompts
 
-    def generate_responses(self, prompts):
+    def request_options(self, user_message, i):
+        """Per-request options for LLMWrapper.generate_responses."""
+        # Identifies this hop of message i, total_round changes with every routed response
+        options = {'key': f"{i}:{user_message['total_round']}", 'agent': user_message['send_to']}
+        # An agent retried after an invalid response sees the same prompt at a later total_round
+        options['cache_salt'] = user_message['total_round']
+        options['stop_at_json'] = user_message['send_to'] in JSON_RESPONSE_AGENTS
+        if user_message['send_to'] in self.sampling_profiles:
+            options['sampling'] = self.sampling_profiles[user_message['send_to']]
+        if user_message['send_to'] in self.json_schemas:
+            options['schema'] = self.json_schemas[user_message['send_to']]
+        # Keep a message's hops, or a table's questions, on one replica's prefix cache
+        if self.affinity == 'message':
+            options['affinity'] = get_message_id(user_message)
+        elif self.affinity == 'table':
+            options['affinity'] = table_key(user_message)
+        timeout = self.agent_timeouts.get(user_message['send_to'])
+        if timeout is not None:
+            options['timeout'] = timeout
+        return options
+
+    def dedup_key(self, user_message, prompt, options):
+        agent = self.agents[user_message['send_to']]
+        return dedup_key(agent.name, prompt, options, agent.num_responses(user_message))
+
+    def generate_responses(self, prompts, request_options=None, dedup_keys=None):
         print("Generating responses")
-        return self.llm.generate_responses(prompts)
+        if self.dedup is None or dedup_keys is None:
+            return self.llm.generate_responses(prompts, request_options=request_options)
+        return self.dedup.generate(dedup_keys, prompts, request_options,
+                                   lambda prompts, request_options: self.llm.generate_responses(prompts, request_options=request_options))
+
+    def take_dedup_stats(self):
+        if self.dedup is None:
+            return {}, {}
+        return self.dedup.take_stats()
+
+    def requeue(self, user_message, failure):
+        """
+        Count a request that produced no output and decide whether its message
+        is retried without spending a round. Timeouts and transport errors share
+        the MAX_STRAGGLER_REQUEUES budget of the hop, after it the hop is
+        processed as an empty response like any other failed generation.
+        """
+        if failure.reason == "timeout":
+            self.stragglers += 1
+            self.straggler_time += failure.elapsed
+        else:
+            self.transport_errors += 1
+        user_message['straggler_requeues'] = user_message.get('straggler_requeues', 0) + 1
+        return user_message['straggler_requeues'] <= MAX_STRAGGLER_REQUEUES
 
     def process_responses(self, user_messages, active_user_messages, responses, args):
         print("Processing responses")
         for i, response in tqdm.tqdm(zip(active_user_messages, responses), total=len(active_user_messages)):
-            user_messages[i] = self.agents[user_messages[i]['send_to']].process_response(user_messages[i], response, args)
+            if isinstance(response, TransportFailure):
+                if self.requeue(user_messages[i], response):
+                    continue
+                response = None
+            self.route_response(user_messages, i, response, args)
+        if self.journal is not None:
+            self.journal.sync()
+        if self.llm.sidecar is not None:
+            # Every response of this round is in the journal now
+            self.llm.sidecar.clear()
         return user_messages
 
+    def route_response(self, user_messages, i, response, args):
+        agent_name, total_round = user_messages[i]['send_to'], user_messages[i]['total_round']
+        invalid_before = user_messages[i].get('invalid_format_rounds', {}).get(agent_name, 0)
+        user_messages[i] = self.agents[agent_name].process_response(user_messages[i], response, args)
+        # The requeue budget is per hop, the next hop starts with a full one
+        user_messages[i].pop('straggler_requeues', None)
+        self.agent_hops[agent_name] = self.agent_hops.get(agent_name, 0) + 1
+        if user_messages[i].get('invalid_format_rounds', {}).get(agent_name, 0) > invalid_before:
+            self.invalid_formats[agent_name] = self.invalid_formats.get(agent_name, 0) + 1
+        if self.journal is not None:
+            self.journal.record(i, agent_name, total_round, response, user_messages[i])
+        if self.indexed_messages is user_messages:
+            del self.queues[agent_name][i]
+            if user_messages[i]['send_to'] != END_NAME:
+                self.queues[user_messages[i]['send_to']][i] = None
+        return user_messages[i]
+
     def process(self, user_messages: list, args):
+        start_time = time.time()
+        self.stragglers, self.straggler_time, self.transport_errors = 0, 0.0, 0
+        self.agent_hops, self.invalid_formats = {}, {}
         active_user_messages, prompts = self.prepare_batch_prompt(user_messages, args)
         if len(prompts) == 0 and len(active_user_messages) == 0:
             return True, user_messages
 
-        responses = self.generate_responses(prompts)
+        prepared_time = time.time()
+        request_options = [self.request_options(user_messages[i], i) for i in active_user_messages]
+        dedup_keys = None
+        if self.dedup is not None:
+            dedup_keys = [self.dedup_key(user_messages[i], prompt, options) for i, prompt, options in zip(active_user_messages, prompts, request_options)]
+        responses = self.generate_responses(prompts, request_options, dedup_keys)
 
+        generated_time = time.time()
         user_messages = self.process_responses(user_messages, active_user_messages, responses, args)
+        num_finished = sum(1 for i in active_user_messages if user_messages[i]['send_to'] == END_NAME)
+        self.report.record_round(len(prompts), num_finished, prepared_time - start_time,
+                                 generated_time - prepared_time, time.time() - generated_time,
+                                 prefix_hit_ratio=estimate_prefix_hit_ratio(prompts),
+                                 stragglers=self.stragglers, straggler_time=self.straggler_time,
+                                 transport_errors=self.transport_errors,
+                                 agent_hops=self.agent_hops, invalid_formats=self.invalid_formats,
+                                 dedup_stats=self.take_dedup_stats())
         return False, user_messages
 
+    def process_continuous(self, user_messages: list, args, on_hop=None):
+        """
+        Run every active message as its own state machine instead of in rounds.
+        As soon as a response arrives it is routed and the next agent's prompt is
+        submitted, so a slow request only delays its own message.
+        on_hop(i, user_message) is called after every routed response.
+        """
+        if self.llm.inference_mode not in ["api", "api_self_hosted"]:
+            raise ValueError(f"Continuous scheduler requires an API inference mode, got {self.llm.inference_mode}")
+        active_user_messages = self.order_active(user_messages)
+        print("Remaining active user messages: ", len(active_user_messages))
+        start_time = time.time()
+        self.stragglers, self.straggler_time, self.transport_errors = 0, 0.0, 0
+        self.agent_hops, self.invalid_formats = {}, {}
+        num_hops = self.llm.run_coroutine(self.run_continuous(user_messages, active_user_messages, args, on_hop))
+        # Prompt building and routing overlap with generation, so the whole run counts as generation
+        self.report.record_round(num_hops, len(active_user_messages), 0.0, time.time() - start_time, 0.0,
+                                 stragglers=self.stragglers, straggler_time=self.straggler_time,
+                                 transport_errors=self.transport_errors,
+                                 agent_hops=self.agent_hops, invalid_formats=self.invalid_formats,
+                                 dedup_stats=self.take_dedup_stats())
+        return user_messages
+
+    async def run_message_hops(self, user_messages, i, args, on_hop=None):
+        """Drive user_messages[i] through its agents until END_NAME. Returns the number of hops."""
+        num_hops = 0
+        while user_messages[i]['send_to'] != END_NAME:
+            agent = self.agents[user_messages[i]['send_to']]
+            prompt = self.llm.format_prompt(**agent.prepare_prompt(user_messages[i], args))
+            # Concurrency and rate limits are applied by the LLMWrapper's limiter
+            options = self.request_options(user_messages[i], i)
+            if self.dedup is None:
+                response = await self.llm.call_llm_api_async_single(prompt, options)
+            else:
+                response = await self.dedup.request(self.dedup_key(user_messages[i], prompt, options),
+                                                    lambda: self.llm.call_llm_api_async_single(prompt, options))
+            if isinstance(response, TransportFailure):
+                if self.requeue(user_messages[i], response):
+                    continue
+                response = None
+            self.route_response(user_messages, i, response, args)
+            num_hops += 1
+            if on_hop is not None:
+                on_hop(i, user_messages[i])
+        return num_hops
+
+    async def run_continuous(self, user_messages, active_user_messages, args, on_hop=None):
+        progress = tqdm.tqdm(total=len(active_user_messages))
+
+        async def run_message(i):
+            num_hops = await self.run_message_hops(user_messages, i, args, on_hop)
+            progress.update(1)
+            return num_hops
+
+        num_hops = await asyncio.gather(*[run_message(i) for i in active_user_messages])
+        progress.close()
+        return sum(num_hops)
+
+    def process_stream(self, message_iter, args, on_finish, max_in_flight=1024):
+        """
+        Continuous scheduling over a lazily read dataset with bounded memory.
+        At most max_in_flight messages are held at once, new ones are read as
+        others finish, and on_finish(dataset_index, user_message) is called for
+        every finished message before it is dropped.
+        """
+        if self.llm.inference_mode not in ["api", "api_self_hosted"]:
+            raise ValueError(f"Streaming requires an API inference mode, got {self.llm.inference_mode}")
+        start_time = time.time()
+        self.stragglers, self.straggler_time, self.transport_errors = 0, 0.0, 0
+        self.agent_hops, self.invalid_formats = {}, {}
+        num_finished, num_hops = self.llm.run_coroutine(self.run_stream(message_iter, args, on_finish, max_in_flight))
+        self.report.record_round(num_hops, num_finished, 0.0, time.time() - start_time, 0.0,
+                                 stragglers=self.stragglers, straggler_time=self.straggler_time,
+                                 transport_errors=self.transport_errors,
+                                 agent_hops=self.agent_hops, invalid_formats=self.invalid_formats,
+                                 dedup_stats=self.take_dedup_stats())
+
+    async def run_stream(self, message_iter, args, on_finish, max_in_flight):
+        in_flight = {} # dataset_index -> user_message
+        progress = tqdm.tqdm()
+        num_finished = 0
+        num_hops = 0
+
+        async def run_message(i):
+            nonlocal num_finished, num_hops
+            hops = await self.run_message_hops(in_flight, i, args)
+            num_hops += hops
+            on_finish(i, in_flight.pop(i))
+            num_finished += 1
+            progress.update(1)
+
+        # The message iterator reads, serializes and tokenizes tables. It is advanced
+        # on a worker thread, one message ahead, so in-flight requests are not
+        # held up on the event loop while the next message is prepared.
+        message_iter = iter(message_iter)
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=1)
+        fetch_next = lambda: loop.run_in_executor(executor, next, message_iter, None)
+        pending = set()
+        try:
+            upcoming = fetch_next()
+            while True:
+                item = await upcoming
+                if item is None:
+                    break
+                upcoming = fetch_next()
+                i, user_message = item
+                if len(pending) >= max_in_flight:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        task.result() # Re-raise errors from finished messages
+                in_flight[i] = user_message
+                pending.add(asyncio.ensure_future(run_message(i)))
+            if pending:
+                await asyncio.gather(*pending)
+        finally:
+            executor.shutdown(wait=False)
+        progress.close()
+        return num_finished, num_hops
+
+    def process_work_queue(self, queue, worker_id, args, lease_size=256):
+        """
+        Pull leased messages from a shared WorkQueue until every message is done.
+        Each lease gets exactly one agent hop before it is put back, so other
+        workers can pick the message up for its next hop. Returns True for the
+        worker that finished the last message, or for every worker when the
+        queue was already done, False for the others.
+        """
+        finished_queue = queue.count_active() == 0
+        while True:
+            leased = queue.lease(worker_id, lease_size)
+            if not leased:
+                remaining = queue.count_active()
+                if remaining == 0:
+                    return finished_queue
+                print(f"{remaining} active user messages are leased by other workers, waiting...")
+                time.sleep(min(30, queue.lease_seconds))
+                continue
+
+            positions = [position for position, _ in leased]
+            user_messages = [user_message for _, user_message in leased]
+            _, user_messages = self.process(user_messages, args)
+            stale, finished = queue.complete(worker_id, zip(positions, user_messages))
+            finished_queue = finished_queue or finished
+            if stale > 0:
+                print(f"Dropped {stale} results whose lease expired and went to another worker")
+
     def job_process(self, user_messages: list, args, job_name):
         active_user_messages, prompts = self.prepare_batch_prompt(user_messages, args)
         if len(prompts) == 0 and len(active_user_messages) == 0:
@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import json
+from collections import OrderedDict
+from const import *
+
+# Request options that change the response, the rest (key, affinity, timeout, cache_salt) only route it
+DEDUP_OPTION_FIELDS = ["sampling", "schema", "stop_at_json"]
+
+
+def dedup_key(agent_name, prompt, options=None, num_responses=0):
+    """
+    Identity of a request for deduplication: the agent, the formatted prompt,
+    the options that change the response, and how many responses of this agent
+    the message already processed. The last part keeps a message that retries
+    an identical prompt, e.g. after an invalid response, from getting the
+    response it already saw, while messages at the same step still share one.
+    """
+    options = options or {}
+    payload = {
+        "prompt": prompt,
+        "options": {name: options.get(name) for name in DEDUP_OPTION_FIELDS},
+        "num_responses": num_responses,
+    }
+    digest = hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+    return (agent_name, digest)
+
+
+class PromptDeduplicator(object):
+    """
+    Collapses identical requests into one LLM call and fans its response out.
+
+    Within a round, requests with the same dedup_key are sent once. Across
+    rounds, the responses of the last max_size keys are remembered, so e.g.
+    a TabFact Checker prompt, which only depends on the answer, or a repeated
+    (table, question) pair is generated once per step. With the continuous
+    scheduler, a request whose key is already in flight waits for that one.
+    Only text responses are remembered, failed requests are sent again.
+    """
+    def __init__(self, max_size=DEDUP_MEMO_SIZE):
+        self.max_size = max_size
+        self.responses = OrderedDict()
+        self.in_flight = {}
+        self.prompts = {}
+        self.deduplicated = {}
+
+    def get(self, key):
+        if key not in self.responses:
+            return None
+        self.responses.move_to_end(key)
+        return self.responses[key]
+
+    def put(self, key, response):
+        if not isinstance(response, str):
+            return
+        self.responses[key] = response
+        self.responses.move_to_end(key)
+        if len(self.responses) > self.max_size:
+            self.responses.popitem(last=False)
+
+    def count(self, key, deduplicated):
+        agent_name = key[0]
+        self.prompts[agent_name] = self.prompts.get(agent_name, 0) + 1
+        if deduplicated:
+            self.deduplicated[agent_name] = self.deduplicated.get(agent_name, 0) + 1
+
+    def take_stats(self):
+        """Per-agent prompts and deduplicated prompts since the last call."""
+        stats = (self.prompts, self.deduplicated)
+        self.prompts, self.deduplicated = {}, {}
+        return stats
+
+    def generate(self, keys, prompts, request_options, generate):
+        """
+        Batch version for round scheduling: generate(prompts, request_options)
+        is called once with the first prompt of every key that is not remembered.
+        """
+        responses = [None] * len(prompts)
+        first = {} # key -> position in the sent prompts
+        send = []
+        for j, key in enumerate(keys):
+            cached = self.get(key)
+            if cached is not None:
+                responses[j] = cached
+                self.count(key, True)
+            elif key in first:
+                self.count(key, True)
+            else:
+                first[key] = len(send)
+                send.append(j)
+                self.count(key, False)
+        if len(send) > 0:
+            print(f"Sending {len(send)} of {len(prompts)} prompts after deduplication")
+            sent = generate([prompts[j] for j in send], [request_options[j] for j in send])
+            for key, position in first.items():
+                self.put(key, sent[position])
+            for j, key in enumerate(keys):
+                if key in first:
+                    responses[j] = sent[first[key]]
+        return responses
+
+    async def request(self, key, send):
+        """Continuous scheduling version: await send() unless the key is remembered or in flight."""
+        cached = self.get(key)
+        if cached is not None:
+            self.count(key, True)
+            return cached
+        if key in self.in_flight:
+            self.count(key, True)
+            # A cancelled waiter must not cancel the request the others wait for
+            return await asyncio.shield(self.in_flight[key])
+        self.count(key, False)
+        future = asyncio.ensure_future(send())
+        self.in_flight[key] = future
+        try:
+            response = await future
+        finally:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+        self.put(key, response)
+        return response
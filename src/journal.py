@@ -0,0 +1,132 @@
+import json
+import os
+from const import *
+from utils import get_message_id
+
+
+class MessageJournal(object):
+    """
+    Append-only write-ahead log of agent hops.
+
+    Every routed response is appended as one compact line instead of rewriting
+    the whole output file each round. The output file keeps the last compacted
+    state, and replaying the journal on top of it restores the run.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, "a", encoding="utf-8")
+
+    def record(self, index, agent_name, total_round, llm_response, user_message):
+        """
+        Record one hop. agent_name and total_round are taken before the hop, so
+        replay can tell whether the hop is already part of the compacted output.
+        """
+        entry = {
+            "index": index,
+            "qs_id": get_message_id(user_message),
+            "agent": agent_name,
+            "total_round": total_round,
+            "response": llm_response,
+            "send_to": user_message["send_to"],
+        }
+        self.fp.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.fp.flush()
+
+    def sync(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def close(self):
+        self.fp.close()
+
+
+class ResponseSidecar(object):
+    """
+    Responses of the current round, appended as soon as each one arrives.
+    Entries are keyed by message key and prompt hash, so a crash in the middle
+    of a round only loses the requests that were still in flight. The file is
+    cleared once the round is in the journal.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.responses = {}
+        for entry in read_log_entries(path):
+            self.responses[(entry["key"], entry["hash"])] = entry["response"]
+        self.fp = open(path, "a", encoding="utf-8")
+
+    def get(self, key, prompt_hash):
+        return self.responses.get((key, prompt_hash))
+
+    def record(self, key, prompt_hash, llm_response):
+        self.responses[(key, prompt_hash)] = llm_response
+        self.fp.write(json.dumps({"key": key, "hash": prompt_hash, "response": llm_response}, ensure_ascii=False) + "\n")
+        self.fp.flush()
+
+    def clear(self):
+        self.responses = {}
+        self.fp.truncate(0)
+
+    def close(self):
+        self.fp.close()
+
+
+def read_log_entries(path):
+    """
+    Read the complete lines of an append-only log. A torn last line from a
+    crash is cut off so that new records start on a clean line.
+    """
+    if not os.path.exists(path):
+        return []
+
+    entries = []
+    valid_size = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+            valid_size += len(line)
+
+    if valid_size != os.path.getsize(path):
+        print(f"Truncating incomplete tail in {path}")
+        with open(path, "r+b") as f:
+            f.truncate(valid_size)
+    return entries
+
+
+def replay_journal(path, user_messages, agents, args):
+    """
+    Re-apply the journaled responses through each agent's process_response.
+    Hops already contained in user_messages are skipped.
+    Returns the number of replayed hops.
+    """
+    replayed = 0
+    for entry in read_log_entries(path):
+        user_message = user_messages[entry["index"]]
+        if user_message["send_to"] != entry["agent"] or user_message["total_round"] != entry["total_round"]:
+            continue
+        user_message = agents[entry["agent"]].process_response(user_message, entry["response"], args)
+        if user_message["send_to"] != entry["send_to"]:
+            raise ValueError(f"Journal replay diverged for message {entry['qs_id']}: "
+                             f"expected {entry['send_to']}, got {user_message['send_to']}")
+        user_messages[entry["index"]] = user_message
+        replayed += 1
+    return replayed
+
+
+def compact_journal(output_file, journal_file, user_messages):
+    """
+    Write the current state as the output JSONL and drop the journal.
+    The output is replaced atomically, and a leftover journal is harmless
+    because replay skips hops that are already applied.
+    """
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as fp:
+        for user_message in user_messages:
+            fp.write(json.dumps(user_message, ensure_ascii=False) + "\n")
+    os.replace(tmp_file, output_file)
+    if os.path.exists(journal_file):
+        os.remove(journal_file)
@@ -1,92 +1,62 @@
 from const import *
-from openai import OpenAI, AsyncOpenAI, AzureOpenAI
+from utils import JsonObjectScanner, get_tokenizer
+from llm_cache import ResponseCache, cache_key
+from balancer import EndpointBalancer
+from vllm_server import VLLMServer
+from rate_limiter import AdaptiveLimiter, is_overload_error, OVERLOAD_STATUS_CODES
+from cassette import LLMCassette
+from batch_emulator import OpenAIBatchEmulator
+from batch_jobs import custom_id, split_requests, manifest_path, read_manifest, write_manifest, read_output_contents, read_error_reasons
+from openai import OpenAI, AsyncOpenAI, AzureOpenAI, APIConnectionError, DefaultAsyncHttpxClient
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from transformers.generation import GenerationConfig
-import torch
-import vllm
 import asyncio
+import httpx
+import threading
 import os
 import json
-import pickle
-import requests
-import subprocess
-import signal
+import hashlib
+import random
 import time
-from asyncio import Semaphore
 from tqdm.asyncio import tqdm_asyncio
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 
 
-def start_vllm(llm_in_use, max_tokens=16384):
-    env = os.environ.copy()
-    env["VLLM_USE_V1"] = "0"
-    reasoning_model = (
-        True if any([u in llm_in_use for u in ["deepseek", "QWQ"]]) else False
-    )
-    model_arg = f"--model {llm_in_use}"
-    if reasoning_model:
-        model_arg += " --reasoning-parser deepseek_r1 --enable-reasoning"
-
-    vllm_cmd = f"""
-    python -m vllm.entrypoints.openai.api_server \
-    {model_arg} \
-    --dtype bfloat16 \
-    --api-key None \
-    --tensor-parallel-size 2 \
-    --host 0.0.0.0 \
-    --port 9876 \
-    --max-model-len {max_tokens} \
-    --distributed-executor-backend ray \
-    --enable-chunked-prefill \
-    --gpu_memory_utilization 0.95 \
-    --disable-uvicorn-access-log \
-    --disable-log-stats \
-    --disable-log-requests \
-    --enable-prefix-caching
+RETRYABLE_STATUS_CODES = [408, 409] + OVERLOAD_STATUS_CODES
+
+
+def is_transient_error(error):
+    """Connection problems and 408/409/429/5xx responses, worth retrying as is."""
+    return isinstance(error, APIConnectionError) or getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES
+
+
+def prompt_hash(prompt):
+    """Stable digest of a formatted prompt, a chat template string or a message list."""
+    return hashlib.sha256(json.dumps(prompt, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class TransportFailure(object):
+    """
+    Returned in place of a response when a request produced no model output:
+    reason is "timeout" when it was cancelled at its deadline and "error" when
+    it kept failing in transit. The Coordinator requeues the message instead of
+    spending one of its reasoning rounds on it.
     """
+    def __init__(self, reason, elapsed=0.0):
+        self.reason = reason
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return f"TransportFailure({self.reason!r}, {self.elapsed:.1f}s)"
 
-    process = subprocess.Popen(
-        vllm_cmd.strip().split(),
-        # stdout=subprocess.PIPE,
-        # stderr=subprocess.STDOUT,
-        env=env,
-        preexec_fn=os.setsid,  # In order to use pgid later to kill the entire process group
-    )
-    print(f"vLLM server started with PID {process.pid}.")
-    return process
-
-
-def wait_for_vllm_ready(port):
-    print("waiting for vLLM server to be ready...")
-    url = f"http://localhost:{port}/v1/models"
-    for _ in range(60 * 15):  # 15 minutes timeout
-        try:
-            print(url)
-            res = requests.get(url, timeout=1)
-            print(res.status_code)
-            if res.status_code == 200:
-                print("vLLM server is ready.")
-                return True
-        except requests.exceptions.RequestException:
-            print("vLLM server is initializing...")
-            pass
-        time.sleep(20)
-    print("vLLM server is not ready after 15 minutes.")
-    return False
-
-
-def stop_vllm(process):
-    print("Stopping vLLM server...")
-    try:
-        os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-        process.wait()
-        print("vLLM server stopped.")
-    except Exception as e:
-        print(f"Error stopping vLLM server: {e}")
 
+class PromptTooLong(ValueError):
+    """The prompt leaves no room for output in the model's context, the request is not sent."""
 
 
 class LLMWrapper:
-    def __init__(self, args):
+    def __init__(self, args, warmup_prompts=None):
         self.llm_in_use = args.llm_in_use
         self.llm_url = args.llm_url
         self.llm_api_key = args.llm_api_key
@@ -94,30 +64,236 @@ class LLMWrapper:
         self.llm = None
         self.tokenizer = None
         self.sampling_params = None
+        self.profile_sampling_params = {} # Per-agent vllm.SamplingParams in offline mode
         self.oai_batch_mode = self.inference_mode == "oai_batch"
         # get the datetime as default suffix for the tmp dir
         self.oai_job_dir = getattr(args, "oai_job_dir", f"./tmp/")
         self.azure_endpoint = getattr(args, "azure_endpoint", None)
+        # Directory of a local OpenAIBatchEmulator that stands in for the Files and Batches API
+        self.oai_emulator = getattr(args, "oai_emulator", None)
+        self.oai_emulator_time_scale = getattr(args, "oai_emulator_time_scale", 1.0)
+        self.oai_emulator_error_rate = getattr(args, "oai_emulator_error_rate", 0.0)
+        # Rounds are split into sub-batches within these limits, handled by oai_batch_workers threads
+        self.oai_batch_max_requests = getattr(args, "oai_batch_max_requests", OAI_BATCH_MAX_REQUESTS)
+        self.oai_batch_max_bytes = getattr(args, "oai_batch_max_bytes", OAI_BATCH_MAX_BYTES)
+        self.oai_batch_workers = getattr(args, "oai_batch_workers", OAI_BATCH_WORKERS)
+        self.oai_batch_max_retries = getattr(args, "oai_batch_max_retries", OAI_BATCH_MAX_RETRIES)
+        self.manifest_lock = threading.Lock()
+        # Optional ResponseSidecar, responses of keyed requests are saved as they arrive
+        self.sidecar = None
+        # Long-lived event loop thread for API requests, started on first use
+        self.loop = None
+        self.loop_thread = None
+        # EndpointBalancer when llm_url lists several replicas, see request_options for affinity
+        self.balancer = None
+        self.affinity = getattr(args, "affinity", "none")
+        # Server management of api_self_hosted mode
+        self.vllm_server = None
+        self.tensor_parallel_size = getattr(args, "tensor_parallel_size", 2)
+        # Context length of the served model. max_tokens is clamped to fit in it where the length is known:
+        # on a server or model started here, or when --max_model_len is given for another endpoint
+        max_model_len = getattr(args, "max_model_len", None)
+        self.clamp_to_model_len = max_model_len is not None or self.inference_mode in ["api_self_hosted", "offline_vllm"]
+        self.max_model_len = max_model_len if max_model_len is not None else MAX_MODEL_LEN
+        self.encode = None # Tokenizer of llm_in_use, loaded the first time a prompt has to be counted
+        self.keep_vllm = getattr(args, "keep_vllm", False)
+        # System prompts prefilled into the self-hosted server's prefix cache once it is ready
+        self.warmup_prompts = warmup_prompts or []
+        # Optional on-disk ResponseCache shared across runs
+        cache_path = getattr(args, "llm_cache", None)
+        self.cache = ResponseCache(cache_path, getattr(args, "llm_cache_max_entries", 1000000)) if cache_path else None
+        # Retries of transient errors and hedging of slow requests
+        self.max_retries = getattr(args, "max_retries", MAX_REQUEST_RETRIES)
+        self.retry_backoff = getattr(args, "retry_backoff", RETRY_BACKOFF_SECONDS)
+        self.hedge_percentile = getattr(args, "hedge_percentile", None)
+        self.latencies = deque(maxlen=HEDGE_WINDOW)
+        self.retries = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        # Stream JSON agents' responses and stop once their JSON object is complete
+        self.stream_json = getattr(args, "stream_json", False)
+        self.early_stops = 0
+        # Send the agent's JSON schema as a decoding constraint: none, response_format or guided_json
+        self.guided_decoding = getattr(args, "guided_decoding", "none")
+        # Optional LLMCassette that records every response, or replays them without a model
+        self.cassette = None
+        self.replay_latency = getattr(args, "llm_replay_latency", False)
+        if getattr(args, "llm_record", None):
+            self.cassette = LLMCassette(args.llm_record, "record")
+        elif getattr(args, "llm_replay", None):
+            self.cassette = LLMCassette(args.llm_replay, "replay")
+        # Shared by every API request of this wrapper, replaces a fixed semaphore
+        self.limiter = AdaptiveLimiter(
+            initial=getattr(args, "initial_concurrency", MAX_CONCURRENT_REQUESTS),
+            min_limit=getattr(args, "min_concurrency", 1),
+            max_limit=getattr(args, "max_concurrency", MAX_ADAPTIVE_CONCURRENCY),
+            rpm=getattr(args, "rpm", None),
+            tpm=getattr(args, "tpm", None),
+        )
         
         self.init_llm()
 
     def close(self):
-        if self.inference_mode == "api_self_hosted":
-            stop_vllm(self.vllm_process)
+        if self.retries > 0 or self.hedged > 0:
+            print(f"LLM request stats: {self.retries} retries, {self.hedged} hedged requests, {self.hedge_wins} won by the hedge")
+        if self.stream_json:
+            print(f"LLM streaming stats: {self.early_stops} responses stopped after their JSON object")
+        if self.cache is not None:
+            print(f"LLM cache stats: {self.cache.stats()}")
+            self.cache.close()
+        if self.balancer is not None:
+            print(f"Replica stats: {self.balancer.stats()}")
+        if self.loop is not None:
+            if self.balancer is not None:
+                self.run_coroutine(self.balancer.close())
+            elif hasattr(self.client, "close"):
+                self.run_coroutine(self.client.close())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+            self.loop.close()
+            self.loop = None
+        if self.vllm_server is not None:
+            self.vllm_server.close()
+        if self.cassette is not None:
+            self.cassette.close()
+
+    def run_coroutine(self, coro):
+        """
+        Run coro on the wrapper's event loop and wait for its result. The loop lives
+        in a background thread for the whole process, so the AsyncOpenAI connection
+        pool stays warm across rounds instead of being rebuilt by asyncio.run.
+        """
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.loop_thread = threading.Thread(target=self.loop.run_forever, name="llm-event-loop", daemon=True)
+            self.loop_thread.start()
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result()
+        except BaseException:
+            # e.g. KeyboardInterrupt in the waiting thread, stop the work on the loop too
+            future.cancel()
+            raise
+
+    def warmup(self, system_prompts):
+        """Load the agents' system prompts into the self-hosted server's prefix cache."""
+        if self.vllm_server is not None and len(system_prompts) > 0:
+            self.vllm_server.warmup(system_prompts)
+
+    def request_sampling(self, options=None):
+        """
+        Sampling parameters of one request: the request's agent profile on top of
+        the local generation config in offline mode, the profile alone in API modes.
+        Also part of the cache key.
+        """
+        sampling = {}
+        if self.sampling_params is not None:
+            sampling = {name: getattr(self.sampling_params, name, None) for name in SAMPLING_FIELDS}
+        profile = (options or {}).get("sampling") or {}
+        sampling.update({name: value for name, value in profile.items() if value is not None})
+        return sampling
+
+    def api_sampling_kwargs(self, prompt, options):
+        profile = options.get("sampling") or {}
+        kwargs = {name: value for name, value in profile.items() if value is not None}
+        kwargs.update(self.guided_decoding_kwargs(options))
+        return kwargs
+
+    def fit_to_model_len(self, prompt, options):
+        """options with the sampling profile's max_tokens clamped by clamp_max_tokens."""
+        max_tokens = (options.get("sampling") or {}).get("max_tokens")
+        if max_tokens is None or not self.clamp_to_model_len:
+            return options
+        clamped = self.clamp_max_tokens(prompt, max_tokens)
+        if clamped == max_tokens:
+            return options
+        return dict(options, sampling=dict(options["sampling"], max_tokens=clamped))
+
+    def clamp_max_tokens(self, prompt, max_tokens):
+        """
+        max_tokens cut to what the prompt leaves of max_model_len, vLLM rejects
+        longer requests instead of stopping early. A prompt has hardly more
+        tokens than characters, so prompts that fit even then are not tokenized.
+        Raises PromptTooLong when nothing is left for the output.
+        """
+        texts = [prompt] if isinstance(prompt, str) else [message['content'] for message in prompt]
+        overhead = PROMPT_TOKENS_PER_MESSAGE * len(texts)
+        if sum(len(text) for text in texts) + overhead + max_tokens <= self.max_model_len:
+            return max_tokens
+        if self.encode is None:
+            self.encode = get_tokenizer(self.llm_in_use)
+        prompt_tokens = sum(len(self.encode(text)) for text in texts) + overhead
+        if prompt_tokens >= self.max_model_len:
+            raise PromptTooLong(f"Prompt of {prompt_tokens} tokens leaves no room for output in max_model_len {self.max_model_len}")
+        return min(max_tokens, self.max_model_len - prompt_tokens)
+
+    def guided_decoding_kwargs(self, options):
+        """
+        The request's JSON schema as an OpenAI structured output response_format,
+        or as vLLM's guided_json extra parameter.
+        """
+        schema = options.get("schema")
+        if schema is None or self.guided_decoding == "none":
+            return {}
+        if self.guided_decoding == "response_format":
+            return {"response_format": {"type": "json_schema", "json_schema": {"name": "agent_response", "schema": schema}}}
+        return {"extra_body": {"guided_json": schema}}
+
+    def offline_sampling_params(self, prompt, options):
+        """vllm.SamplingParams of one request, shared by requests with the same profile."""
+        import vllm
+        options = self.fit_to_model_len(prompt, options or {})
+        profile = options.get("sampling")
+        if not profile:
+            return self.sampling_params
+        key = json.dumps(profile, sort_keys=True)
+        if key not in self.profile_sampling_params:
+            self.profile_sampling_params[key] = vllm.SamplingParams(**self.request_sampling(options))
+        return self.profile_sampling_params[key]
+
+    def request_cache_key(self, prompt, options=None):
+        if self.cache is None:
+            return None
+        sampling = self.request_sampling(options)
+        if self.guided_decoding_kwargs(options or {}):
+            # Constrained and unconstrained responses to the same prompt differ
+            sampling["schema"] = options["schema"]
+        return cache_key(self.llm_in_use, prompt, sampling, (options or {}).get("cache_salt"))
 
     def init_llm(self):
+        if self.cassette is not None and self.oai_batch_mode:
+            raise ValueError("Recording and replaying LLM responses is not supported in oai_batch mode")
+        if self.cassette is not None and self.cassette.replaying:
+            # No model, server or client; offline mode still needs the chat template
+            self.client = None
+            if self.inference_mode == 'offline_vllm':
+                self.tokenizer = AutoTokenizer.from_pretrained(self.llm_in_use)
+            return
         if self.inference_mode in ["api", "api_self_hosted"]:
             if self.inference_mode == "api_self_hosted":
-                # Start vllm server
-                self.vllm_process = start_vllm(self.llm_in_use)
-                if wait_for_vllm_ready(9876):
-                    print("vLLM server is ready.")
-            self.client = AsyncOpenAI(
-                base_url=self.llm_url,
-                api_key=self.llm_api_key,
-            )
+                # Reuse a server that already serves the model, or start one
+                self.vllm_server = VLLMServer(
+                    self.llm_in_use, self.llm_url.split(",")[0], self.llm_api_key,
+                    tensor_parallel_size=self.tensor_parallel_size, max_model_len=self.max_model_len,
+                    keep_running=self.keep_vllm,
+                )
+                self.vllm_server.ensure_running()
+                self.max_model_len = self.vllm_server.max_model_len
+                self.warmup(self.warmup_prompts)
+            urls = [url.strip() for url in self.llm_url.split(",")]
+            if len(urls) > 1:
+                self.balancer = EndpointBalancer(urls, self.make_async_client)
+                self.client = self.balancer.replicas[0].client
+                print(f"Balancing requests over {len(urls)} replicas, affinity: {self.affinity}")
+            else:
+                self.client = self.make_async_client(self.llm_url)
         elif self.inference_mode == "oai_batch":
-            if self.azure_endpoint is not None:
+            if self.oai_emulator is not None:
+                self.client = OpenAIBatchEmulator(
+                    self.oai_emulator, time_scale=self.oai_emulator_time_scale,
+                    error_rate=self.oai_emulator_error_rate, model=self.llm_in_use,
+                )
+            elif self.azure_endpoint is not None:
                 api_version = self.azure_endpoint.split("api-version=")[-1]
                 self.client = AzureOpenAI(
                     azure_endpoint=self.azure_endpoint,
@@ -134,7 +310,22 @@ class LLMWrapper:
                 model_name=self.llm_in_use
             )
 
+    def make_async_client(self, url):
+        # One keep-alive pool for the whole process, used from the wrapper's event loop.
+        # Retries are done by call_llm_api_async_single, where the limiter sees them.
+        return AsyncOpenAI(
+            base_url=url,
+            api_key=self.llm_api_key,
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=self.limiter.max_limit)
+            ),
+        )
+
     def load_local_llm(self, model_name):
+        # Imported here so that replaying a cassette needs neither a GPU nor vllm
+        import torch
+        import vllm
         tokenizer = AutoTokenizer.from_pretrained(model_name)
         generation_config = GenerationConfig.from_pretrained(model_name)
         sampling_params = vllm.SamplingParams(
@@ -151,7 +342,7 @@ class LLMWrapper:
             dtype="bfloat16" if torch.cuda.is_bf16_supported() else "float16",
             distributed_executor_backend="ray",
             enable_prefix_caching=True,
-            max_model_len=16384,
+            max_model_len=self.max_model_len,
             gpu_memory_utilization=0.95,
             max_num_seqs=32,
         )
@@ -170,16 +361,64 @@ class LLMWrapper:
         else:
             return message_list
 
-    def generate_responses(self, prompts, post_process=lambda x: x.replace("<|start_header_id|>assistant<|end_header_id|>", "").strip()):
+    def generate_responses(self, prompts, post_process=lambda x: x.replace("<|start_header_id|>assistant<|end_header_id|>", "").strip(), request_options=None):
+        """
+        request_options is an optional list with one dict per prompt:
+        - timeout: seconds before the request is cancelled (API modes only)
+        - key: stable id of the request, used to save and reuse its response in the sidecar
+        - cache_salt: added to the response cache key so retries of the same prompt are not served from the cache
+        - stop_at_json: with stream_json, stop generating once the response holds a complete JSON object (API modes only)
+        - affinity: requests with the same key go to the same replica when llm_url lists several
+        - sampling: the agent's sampling profile, e.g. max_tokens, stop and temperature
+        - schema: JSON schema of the agent's response, sent as a decoding constraint with guided_decoding (API modes only)
+        - agent: name of the requesting agent, the limiter compares latencies per agent
+        """
         if self.inference_mode == 'offline_vllm':
-            model_outputs = self.llm.generate(
-                prompts, sampling_params=self.sampling_params
-            )
-            responses = [post_process(output.outputs[0].text) for output in model_outputs]
+            if request_options is None:
+                request_options = [None] * len(prompts)
+            if self.cassette is not None:
+                slots = [self.cassette.next_slot(prompt, options) for prompt, options in zip(prompts, request_options)]
+                if self.cassette.replaying:
+                    return [post_process(text) if text is not None else None for text in self.replay_batch(slots)]
+            keys = [self.request_cache_key(prompt, options) for prompt, options in zip(prompts, request_options)]
+            texts = [self.cache.get(key) if key is not None else None for key in keys]
+            latencies = [0.0] * len(prompts)
+            missing = [j for j, text in enumerate(texts) if text is None]
+            sampling_params = {}
+            for j in missing:
+                try:
+                    sampling_params[j] = self.offline_sampling_params(prompts[j], request_options[j])
+                except PromptTooLong as e:
+                    # Left without a response, like a generation that failed
+                    print(f"Skipping request: {e}")
+            missing = [j for j in missing if j in sampling_params]
+            if len(missing) > 0:
+                start_time = time.time()
+                model_outputs = self.llm.generate(
+                    [prompts[j] for j in missing],
+                    sampling_params=[sampling_params[j] for j in missing],
+                )
+                for j, output in zip(missing, model_outputs):
+                    texts[j] = output.outputs[0].text
+                    # The batch is generated at once, every prompt takes the batch time
+                    latencies[j] = time.time() - start_time
+                    if keys[j] is not None:
+                        self.cache.put(keys[j], texts[j])
+            if self.cassette is not None:
+                for slot, text, latency in zip(slots, texts, latencies):
+                    self.cassette.record(slot, text, latency)
+            responses = [post_process(text) if text is not None else None for text in texts]
         else:
-            responses = asyncio.run(self.call_llm_api_async(prompts))
+            responses = self.run_coroutine(self.call_llm_api_async(prompts, request_options))
         return responses
 
+    def replay_batch(self, slots):
+        """Recorded texts of an offline batch, which takes as long as its slowest prompt with replay_latency."""
+        entries = [self.cassette.play(slot) for slot in slots]
+        if self.replay_latency and len(entries) > 0:
+            time.sleep(max(entry["latency"] for entry in entries))
+        return [entry["response"] for entry in entries]
+
     def call_llm_api(self, system_prompt: str, user_prompt: str):
         messages = self.format_prompt(system_prompt, user_prompt)
         completion = self.client.chat.completions.create(
@@ -190,41 +429,233 @@ class LLMWrapper:
         return completion.choices[0].message.content.strip()
 
 
-    async def call_llm_api_async_single(self, prompt):
-
+    async def call_llm_api_async_single(self, prompt, options=None, slot=None):
+        """
+        Returns the response text, None when the model gave no usable answer, or
+        a TransportFailure when the request timed out or kept failing in transit.
+        Transient errors are retried with exponential backoff.
+        slot is the request's cassette slot when the caller took it in advance.
+        """
+        options = options or {}
+        if self.cassette is None:
+            return await self.fetch_response(prompt, options)
+        if slot is None:
+            slot = self.cassette.next_slot(prompt, options)
+        if self.cassette.replaying:
+            entry = self.cassette.play(slot)
+            if self.replay_latency:
+                await asyncio.sleep(entry["latency"])
+            if entry["failure"] is not None:
+                return TransportFailure(entry["failure"], entry["latency"])
+            return entry["response"]
+        start_time = time.time()
+        response = await self.fetch_response(prompt, options)
+        if isinstance(response, TransportFailure):
+            self.cassette.record(slot, None, time.time() - start_time, failure=response.reason)
+        else:
+            self.cassette.record(slot, response, time.time() - start_time)
+        return response
+
+    async def fetch_response(self, prompt, options):
+        key = self.request_cache_key(prompt, options)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
         try:
-            completion = await self.client.chat.completions.create(
-                model=self.llm_in_use,
-                messages=prompt,
-            )
-            return completion.choices[0].message.content.strip()
+            options = self.fit_to_model_len(prompt, options)
+        except PromptTooLong as e:
+            print(f"Skipping request: {e}")
+            return None
+        start_time = time.time()
+        for attempt in range(self.max_retries + 1):
+            try:
+                content = await self.request_completion(prompt, options)
+                if content is None:
+                    return None
+                response = content.strip()
+                if key is not None:
+                    self.cache.put(key, response)
+                return response
+            except asyncio.TimeoutError:
+                return TransportFailure("timeout", time.time() - start_time)
+            except Exception as e:
+                if not is_transient_error(e):
+                    print(f"Error: {e}")
+                    return None
+                if attempt == self.max_retries:
+                    print(f"Error after {attempt + 1} attempts: {e}")
+                    return TransportFailure("error", time.time() - start_time)
+                # Full jitter keeps many failed requests from retrying in lockstep
+                delay = random.uniform(0, min(MAX_RETRY_BACKOFF, self.retry_backoff * 2 ** attempt))
+                self.retries += 1
+                print(f"Retrying in {delay:.1f}s after error: {e}")
+                await asyncio.sleep(delay)
+
+    async def request_completion(self, prompt, options):
+        """One attempt under the limiter, cancelled after the timeout in options. Returns the content."""
+        await self.limiter.acquire(prompt)
+        start_time = time.time()
+        overloaded = False
+        try:
+            content = await asyncio.wait_for(self.hedged_completion(prompt, options), timeout=options.get("timeout"))
+            self.latencies.append(time.time() - start_time)
+            return content
         except Exception as e:
-            print(f"Error: {e}")
+            overloaded = is_overload_error(e)
+            raise
+        finally:
+            await self.limiter.release(time.time() - start_time, overloaded, kind=options.get("agent"))
+
+    def hedge_delay(self):
+        """Latency at hedge_percentile of recent requests, None while hedging is off or warming up."""
+        if self.hedge_percentile is None or len(self.latencies) < HEDGE_MIN_SAMPLES:
             return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))]
+
+    async def hedged_completion(self, prompt, options):
+        """
+        Send the request, and a duplicate once it is slower than hedge_delay.
+        The first successful copy wins and the other one is cancelled.
+        """
+        first = asyncio.ensure_future(self.create_completion(prompt, options, options.get("affinity")))
+        copies = [first]
+        tasks = {first}
+        try:
+            delay = self.hedge_delay()
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    self.hedged += 1
+                    copies.append(asyncio.ensure_future(self.hedge_completion(prompt, options)))
+                    tasks.add(copies[-1])
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.hedge_wins += 1
+                        return task.result()
+            # Every copy failed, surface the original error
+            return first.result()
+        finally:
+            for task in copies:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception() # Mark the error of a losing copy as retrieved
         
     
-    async def call_llm_api_async(self, prompts):
-        sem = Semaphore(16) # Limit the number of concurrent requests
+    async def hedge_completion(self, prompt, options):
+        """
+        The duplicate of a slow request. It takes its own limiter slot and rate
+        budget, so hedging stays within the concurrency and RPM/TPM limits.
+        """
+        await self.limiter.acquire(prompt)
+        start_time = time.time()
+        overloaded = False
+        observed = True
+        try:
+            # The duplicate ignores affinity, so it can land on a less loaded replica
+            return await self.create_completion(prompt, options)
+        except asyncio.CancelledError:
+            observed = False
+            raise
+        except Exception as e:
+            overloaded = is_overload_error(e)
+            raise
+        finally:
+            await self.limiter.release(time.time() - start_time, overloaded, observed, kind=options.get("agent"))
+
+    async def create_completion(self, prompt, options, affinity_key=None):
+        """One chat completion request, on a replica picked by the balancer if there is one. Returns its content."""
+        if self.balancer is None:
+            return await self.complete_on(self.client, prompt, options)
+        return await self.balancer.request(affinity_key, lambda client: self.complete_on(client, prompt, options))
+
+    async def complete_on(self, client, prompt, options):
+        if self.stream_json and options.get("stop_at_json"):
+            return await self.stream_until_json(client, prompt, options)
+        completion = await client.chat.completions.create(model=self.llm_in_use, messages=prompt, **self.api_sampling_kwargs(prompt, options))
+        return completion.choices[0].message.content
+
+    async def stream_until_json(self, client, prompt, options):
+        """
+        Stream the completion and stop it as soon as a complete JSON object has
+        arrived. Agents only parse that object, so the tokens after it are
+        commentary the server no longer has to decode.
+        """
+        scanner = JsonObjectScanner()
+        stream = await client.chat.completions.create(model=self.llm_in_use, messages=prompt, stream=True, **self.api_sampling_kwargs(prompt, options))
+        try:
+            async for chunk in stream:
+                if len(chunk.choices) == 0 or not chunk.choices[0].delta.content:
+                    continue
+                if scanner.feed(chunk.choices[0].delta.content):
+                    self.early_stops += 1
+                    break
+        finally:
+            # Closing the connection makes the server abort the rest of the generation
+            await stream.close()
+        return scanner.text
+
+    async def call_llm_api_async(self, prompts, request_options=None):
+        if request_options is None:
+            request_options = [None] * len(prompts)
         
-        async def generate_one_sample_limited(prompt):
-            async with sem:
-                return await self.call_llm_api_async_single(prompt)
-
-        return await tqdm_asyncio.gather(*[generate_one_sample_limited(prompt) for prompt in prompts])
+        reused = 0
+        # gather starts the requests in no particular order, cassette slots follow the prompt order
+        slots = [None] * len(prompts)
+        if self.cassette is not None:
+            slots = [self.cassette.next_slot(prompt, options) for prompt, options in zip(prompts, request_options)]
+        
+        async def generate_one_sample(prompt, options, slot):
+            nonlocal reused
+            key = (options or {}).get("key")
+            use_sidecar = self.sidecar is not None and key is not None
+            if use_sidecar:
+                digest = prompt_hash(prompt)
+                response = self.sidecar.get(key, digest)
+                if response is not None:
+                    reused += 1
+                    return response
+            response = await self.call_llm_api_async_single(prompt, options, slot)
+            if use_sidecar and isinstance(response, str):
+                self.sidecar.record(key, digest, response)
+            return response
+
+        responses = await tqdm_asyncio.gather(*[generate_one_sample(prompt, options, slot) for prompt, options, slot in zip(prompts, request_options, slots)])
+        if reused > 0:
+            print(f"Reused {reused} responses saved before the last interruption")
+        return responses
     
 
     def submit_batch_job(self, prompts, job_name):
+        """
+        Submit a round as sub-batches within the request and file size limits,
+        uploaded concurrently. The round's manifest records every sub-batch as
+        soon as it is created, so a rerun after an interruption only submits
+        the rest. Returns the batch ids, or None if the round was submitted before.
+        """
         job_dir = self.oai_job_dir
-        # Check if the job is already submitted with f"{job_name}_reciept.pkl"
-        if os.path.exists(
-            os.path.join(job_dir, f"{job_name}_reciept.pkl")
-        ):
+        manifest = read_manifest(job_dir, job_name)
+        if manifest is None:
+            manifest = self.plan_batch_job(prompts, job_name)
+        pending = [shard for shard in manifest["shards"] if shard["batch_id"] is None]
+        if len(pending) == 0:
             print(f"Job {job_name} already submitted, skipping...")
             return None
-                
+        self.submit_batch_shards(job_name, manifest, pending)
+        print(f"Job {job_name} submitted as {len(manifest['shards'])} sub-batches, manifest: {manifest_path(job_dir, job_name)}")
+        return [shard["batch_id"] for shard in manifest["shards"]]
+
+    def plan_batch_job(self, prompts, job_name):
+        """Write the sub-batch input files of a round and its manifest, before anything is uploaded."""
+
         def format_prompt(message, model_name: str, prompt_id: int):
             return {
-                "custom_id": f"request-{prompt_id}",
+                "custom_id": custom_id(prompt_id),
                 "method": "POST",
                 "url": "/v1/chat/completions",
                 "body": {
@@ -232,93 +663,155 @@ class LLMWrapper:
                     "messages": message,
                 },
             }
-        model_inputs = [
-            format_prompt(prompt, self.llm_in_use, i) for i, prompt in enumerate(prompts)
+        lines = [
+            json.dumps(format_prompt(prompt, self.llm_in_use, i)) for i, prompt in enumerate(prompts)
         ]
-        
-        os.makedirs(job_dir, exist_ok=True)
-        with open(f"{job_dir}/{job_name}.jsonl", "w") as f:
-            for input_data in model_inputs:
-                f.write(json.dumps(input_data) + "\n")
-
-            
-        batch_input_file = self.client.files.create(
-            file=open(f"{job_dir}/{job_name}.jsonl", "rb"),
-            purpose="batch",
-        )
 
-        
-        print(batch_input_file)
-
-            
-        batch_input_file_id = batch_input_file.id
-        reciept = self.client.batches.create(
-            input_file_id=batch_input_file_id,
-            endpoint="/v1/chat/completions",
-            completion_window="24h",
-            metadata={"description": "TableQA batch job"},
-        )
-            
-        print(f"Reciept created: {reciept}")
-        # Save the reciept to a pickle file in tmp directory
-        output_path = os.path.join(job_dir, f"{job_name}_reciept.pkl")
+        os.makedirs(self.oai_job_dir, exist_ok=True)
+        manifest = {"job_name": job_name, "requests": len(prompts), "shards": []}
+        self.add_batch_shards(manifest, lines, f"{job_name}_part", 0)
+        return manifest
+
+    def add_batch_shards(self, manifest, lines, prefix, attempt):
+        """Split request lines into sub-batch input files named after prefix and add them to the manifest."""
+        shards = []
+        for part, shard_lines in enumerate(split_requests(lines, self.oai_batch_max_requests, self.oai_batch_max_bytes)):
+            input_file = f"{prefix}{part}.jsonl"
+            with open(os.path.join(self.oai_job_dir, input_file), "w") as f:
+                for line in shard_lines:
+                    f.write(line + "\n")
+            shards.append({
+                "index": len(manifest["shards"]) + part,
+                # 0 for the round's requests, n for the nth follow-up batch of failed ones
+                "attempt": attempt,
+                "input_file": input_file,
+                "requests": len(shard_lines),
+                "input_file_id": None,
+                "batch_id": None,
+                "output_file": f"{prefix}{part}_output.jsonl",
+            })
+        manifest["shards"].extend(shards)
+        write_manifest(self.oai_job_dir, manifest)
+        return shards
+
+    def submit_batch_shards(self, job_name, manifest, shards):
+        job_dir = self.oai_job_dir
 
-        with open(output_path, "wb") as f:
-            pickle.dump(reciept, f)
+        def submit_shard(shard):
+            with open(os.path.join(job_dir, shard["input_file"]), "rb") as f:
+                batch_input_file = self.client.files.create(file=f, purpose="batch")
+            print(batch_input_file)
+            reciept = self.client.batches.create(
+                input_file_id=batch_input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+                metadata={"description": "TableQA batch job", "job_name": job_name, "shard": str(shard["index"])},
+            )
+            print(f"Reciept created: {reciept}")
+            with self.manifest_lock:
+                shard["input_file_id"] = batch_input_file.id
+                shard["batch_id"] = reciept.id
+                write_manifest(job_dir, manifest)
 
-        return reciept.id
+        with ThreadPoolExecutor(max_workers=min(self.oai_batch_workers, len(shards))) as executor:
+            # list() raises the first failed upload once the others are recorded
+            list(executor.map(submit_shard, shards))
 
     def fetch_batch_job_results(self, job_name):
+        """
+        Poll the round's unfinished sub-batches concurrently and stream each
+        finished output and error file to disk. Once every sub-batch is in,
+        the responses are joined by custom_id, since output lines come in any
+        order, and returned in prompt order. Requests that failed, expired or
+        are missing from the output go into a follow-up batch of their own, up
+        to oai_batch_max_retries times, so the rest of the round is not paid
+        for again; after that they are returned as TransportFailures and the
+        Coordinator requeues their messages. None while any sub-batch runs.
+        """
         job_dir = self.oai_job_dir
-        job_result_file = os.path.join(job_dir, f"{job_name}_batch_output.jsonl")
-        # Check if the job is already fetched with f"{job_name}_batch_output.jsonl"
-        if os.path.exists(job_result_file):
+        manifest = read_manifest(job_dir, job_name)
+        unsubmitted = [shard for shard in manifest["shards"] if shard["batch_id"] is None]
+        if len(unsubmitted) > 0:
+            # Interrupted between writing and submitting a follow-up batch
+            self.submit_batch_shards(job_name, manifest, unsubmitted)
+        pending = [shard for shard in manifest["shards"] if not self.batch_shard_fetched(shard)]
+        if len(pending) == 0:
             print(f"Job {job_name} already fetched, load results...")
-            job_results = []
-            with open(job_result_file, "r") as f:
-                for line in f:
-                    job_results.append(json.loads(line))
-            llm_run_results = []
-            for i, result in enumerate(job_results):
-                response = result["response"]["body"]["choices"][0]["message"]["content"].strip()
-                llm_run_results.append(response)
-            print(f"Job results loaded, total {len(llm_run_results)} results")
-            return llm_run_results
-
-        with open(os.path.join(job_dir, f"{job_name}_reciept.pkl"), "rb") as f:
-            reciept = pickle.load(f)
-        
-        retrieved_information = self.client.batches.retrieve(reciept.id)
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.oai_batch_workers, len(pending))) as executor:
+                fetched = list(executor.map(lambda shard: self.fetch_batch_shard(manifest, shard), pending))
+            if not all(fetched):
+                print(f"Job {job_name}: {fetched.count(False)} of {len(manifest['shards'])} sub-batches not finished")
+                return None
+
+        contents, reasons = {}, {}
+        for shard in manifest["shards"]:
+            output_path = os.path.join(job_dir, shard["output_file"])
+            if os.path.exists(output_path):
+                contents.update(read_output_contents(output_path))
+            if shard.get("error_file") is not None:
+                reasons.update(read_error_reasons(os.path.join(job_dir, shard["error_file"])))
+        missing = [custom_id(i) for i in range(manifest["requests"]) if custom_id(i) not in contents]
+        if len(missing) > 0:
+            attempt = max(shard.get("attempt", 0) for shard in manifest["shards"])
+            reason_counts = dict(Counter(reasons.get(request_id, "missing") for request_id in missing))
+            print(f"Job {job_name}: {len(missing)} of {manifest['requests']} requests without a response {reason_counts}")
+            if attempt < self.oai_batch_max_retries and self.submit_batch_retry(job_name, manifest, set(missing), attempt + 1):
+                return None
+            print(f"Job {job_name}: giving up on {len(missing)} requests after {attempt} follow-up batches, their messages are requeued")
+        llm_run_results = [contents.get(custom_id(i), TransportFailure("error")) for i in range(manifest["requests"])]
+        print(f"Job results loaded, total {len(llm_run_results)} results")
+        return llm_run_results
+
+    def submit_batch_retry(self, job_name, manifest, missing, attempt):
+        """Submit a follow-up batch of the requests in missing, False if their input lines are gone."""
+        lines = []
+        for shard in manifest["shards"]:
+            input_path = os.path.join(self.oai_job_dir, shard["input_file"])
+            if shard.get("attempt", 0) != 0 or not os.path.exists(input_path):
+                continue
+            with open(input_path, "r") as f:
+                lines.extend(line.rstrip("\n") for line in f if line.strip() and json.loads(line)["custom_id"] in missing)
+        if len(lines) == 0:
+            return False
+        shards = self.add_batch_shards(manifest, lines, f"{job_name}_retry{attempt}_part", attempt)
+        self.submit_batch_shards(job_name, manifest, shards)
+        print(f"Job {job_name}: follow-up batch {attempt} submitted for {len(lines)} requests")
+        return True
+
+    def batch_shard_fetched(self, shard):
+        # Manifests before follow-up batches have no status, their fetched sub-batches have an output file
+        return shard.get("status") is not None or os.path.exists(os.path.join(self.oai_job_dir, shard["output_file"]))
+
+    def fetch_batch_shard(self, manifest, shard):
+        """Download the output and error files of a sub-batch that ended, True once they are on disk."""
+        retrieved_information = self.client.batches.retrieve(shard["batch_id"])
         job_status = retrieved_information.status
-        print(f"Reciept status: {job_status}")
-        uncomplete_status = [ "failed", "in_progress", "validating", "finalizing" ]
-        if uncomplete_status.count(job_status) > 0:
+        print(f"Reciept status of sub-batch {shard['index']}: {job_status}")
+        if job_status not in OAI_BATCH_FINAL_STATUS:
             print(f"Job: {job_status}")
             print(retrieved_information)
-            return None
-        
-            
-        assert job_status == "completed"
-        print(retrieved_information.request_counts.__dict__)
+            return False
 
-        job_file_id = retrieved_information.output_file_id
-        print(f"Job file id: {job_file_id}")
-
-        # Download the results
-        file_response = self.client.files.content(job_file_id)
-
-        with open(job_result_file, "w") as f:
-            f.write(file_response.text)
-        print(f"Job results saved to {job_result_file}")
-
-        # Load the results
-        job_results = []
-        with open(job_result_file, "r") as f:
-            for line in f:
-                job_results.append(json.loads(line))
-        llm_run_results = []
-        for i, result in enumerate(job_results):
-            response = result["response"]["body"]["choices"][0]["message"]["content"].strip()
-            llm_run_results.append(response)
-        print(f"Job results loaded, total {len(llm_run_results)} results")
-        return llm_run_results
\ No newline at end of file
+        print(retrieved_information.request_counts.__dict__)
+        if job_status != "completed":
+            # Requests without output are retried in a follow-up batch
+            print(f"Sub-batch {shard['index']} {job_status}: {retrieved_information.errors}")
+        error_file = shard["output_file"].replace("_output.jsonl", "_errors.jsonl")
+        for file_id, file_name in [(retrieved_information.error_file_id, error_file),
+                                   (retrieved_information.output_file_id, shard["output_file"])]:
+            if file_id is None:
+                continue
+            print(f"Job file id: {file_id}")
+            # Stream the results to a temporary file, a partial download is never taken for a finished one
+            output_path = os.path.join(self.oai_job_dir, file_name)
+            with self.client.files.with_streaming_response.content(file_id) as file_response:
+                file_response.stream_to_file(output_path + ".tmp")
+            os.replace(output_path + ".tmp", output_path)
+            print(f"Job results saved to {output_path}")
+        with self.manifest_lock:
+            if retrieved_information.error_file_id is not None:
+                shard["error_file"] = error_file
+            shard["status"] = job_status
+            write_manifest(self.oai_job_dir, manifest)
+        return True
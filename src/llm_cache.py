@@ -0,0 +1,82 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+EVICT_EVERY = 256 # Puts between two eviction passes
+
+
+def cache_key(model, prompt, sampling=None, salt=None):
+    """
+    Content address of one request: the model, the formatted prompt and the sampling parameters.
+    salt separates repeated requests with the same prompt, e.g. a retry after an invalid
+    response, which must not get the same cached response again.
+    """
+    payload = {"model": model, "prompt": prompt, "sampling": sampling or {}, "salt": salt}
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of LLM responses keyed by cache_key, shared across runs and processes.
+
+    Only the requests whose prompt or sampling parameters changed since an earlier
+    run reach the model. The least recently used entries are evicted once the
+    cache holds more than max_entries responses.
+    """
+    def __init__(self, path, max_entries=1000000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        # Used from the LLMWrapper's event loop thread, never from two threads at once
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+    def get(self, key):
+        row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key, response):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, response, last_used) VALUES (?, ?, ?)",
+            (key, response, time.time()),
+        )
+        self.puts += 1
+        if self.puts % EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """Drop the least recently used responses beyond max_entries. Returns the number dropped."""
+        cursor = self.conn.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        return cursor.rowcount
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups > 0 else 0.0,
+            "entries": self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0],
+        }
+
+    def close(self):
+        self.evict()
+        self.conn.close()
@@ -224,7 +224,7 @@ class AgenticMemorySystem:
         self.retriever = ChromaRetriever(collection_name="memories")
         
         # Initialize LLM controller
-        self.llm = LLMWrapper(args)
+        self.llm = LLMWrapper(args, warmup_prompts=[optional_evolution_system, always_evolve_system])
         self.evo_threshold = evo_threshold
 
     def add_note(self,
@@ -739,7 +739,7 @@ class AgenticMemorySystem:
         )
         prompts = self.llm.format_prompt(optional_evolution_system, user_prompt)
         print(f"finish prepareing prompts: {prompts}")
-        response = self.llm.generate_responses(prompts)
+        response = self.llm.generate_responses([prompts])
         print(f"get response form llm: {response}")
         
         if response and isinstance(response, list):
@@ -811,7 +811,7 @@ class AgenticMemorySystem:
         )
         prompts = self.llm.format_prompt(always_evolve_system, user_prompt)
         print(f"finish prepareing prompts: {prompts}")
-        response = self.llm.generate_responses(prompts)
+        response = self.llm.generate_responses([prompts])
         print(f"get response form llm: {response}")
         
         if response and isinstance(response, list):
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import random
+import threading
+from const import *
+
+FILLER_WORDS = ["filter", "rows", "where", "the", "column", "matches", "value", "count", "compare", "table", "year", "total"]
+
+
+class MockResponder(object):
+    """
+    Agent-shaped responses for benchmarks and tests without a model.
+
+    The agent is recognised from the system prompt of the request, and the
+    response is what that agent's process_response parses: a Solver that
+    transforms the table (answer <NOT_READY>) or answers, a Checker that passes
+    the answer with pass_rate or scores it lower, a Reflector diagnosis, a
+    Baseline "The answer is" line, a Result_Analyze summary, or a memory
+    evolution decision. With invalid_rate a response is plain text instead of
+    JSON, as a malformed model response would be. Responses only depend on the
+    seed, the prompt and how often the same prompt was answered before, so
+    runs are repeatable whatever order concurrent requests arrive in.
+    """
+    def __init__(self, seed=0, not_ready_rate=0.3, pass_rate=0.7, invalid_rate=0.0, filler_words=40):
+        self.seed = seed
+        self.not_ready_rate = not_ready_rate
+        self.pass_rate = pass_rate
+        self.invalid_rate = invalid_rate
+        self.filler_words = filler_words
+        self.seen = {}
+        self.lock = threading.Lock()
+        self.agents = {}
+        for dataset_name, prompts in DATASET_PROMPTS.items():
+            for agent_name, prompt in prompts.items():
+                self.agents[prompt["system_prompt"].strip()] = (dataset_name, agent_name)
+        for dataset_name, variants in STANDARD_BASELINE_PROMPTS.items():
+            for prompt in variants.values():
+                self.agents[prompt["system_prompt"].strip()] = (dataset_name, BASELINE_NAME)
+        self.agents[result_analyze_system.strip()] = (None, RA_NAME)
+        self.agents[optional_evolution_system.strip()] = (None, "Evolution")
+        self.agents[always_evolve_system.strip()] = (None, "Evolution")
+
+    def rng(self, messages):
+        digest = hashlib.sha256(json.dumps(messages, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+        with self.lock:
+            count = self.seen.get(digest, 0)
+            self.seen[digest] = count + 1
+        return random.Random(f"{self.seed}:{digest}:{count}")
+
+    def filler(self, rng):
+        return " ".join(rng.choice(FILLER_WORDS) for _ in range(self.filler_words))
+
+    def respond(self, messages):
+        """Response text for an OpenAI chat messages list, or a chat template string."""
+        rng = self.rng(messages)
+        system_prompt = messages[0]["content"].strip() if isinstance(messages, list) and len(messages) > 0 else ""
+        dataset_name, agent_name = self.agents.get(system_prompt, (None, None))
+        if agent_name is None:
+            return f"The answer is: {rng.choice(['true', 'false'])}"
+        if agent_name == BASELINE_NAME:
+            return f"{self.filler(rng)}\nThe answer is: {self.answer(dataset_name, rng)}"
+        if rng.random() < self.invalid_rate:
+            return f"I need to {self.filler(rng)}, so the answer is {self.answer(dataset_name, rng)}"
+        if agent_name == REASONER_NAME:
+            result = self.solver(dataset_name, rng)
+        elif agent_name == CHECKER_NAME:
+            result = self.checker(dataset_name, rng)
+        elif agent_name == REFLECTOR_NAME:
+            result = {"diagnosis": self.filler(rng), "improvement_plan": self.filler(rng)}
+        elif agent_name == RA_NAME:
+            result = self.result_analyze(rng)
+        else:
+            result = {"should_evolve": False, "actions": [], "suggested_connections": [], "tags_to_update": [],
+                      "new_context_neighborhood": [], "new_tags_neighborhood": []}
+        return "```json\n" + json.dumps(result, indent=2) + "\n```"
+
+    def answer(self, dataset_name, rng):
+        if dataset_name == TAB_NAME:
+            return rng.choice(["true", "false"])
+        return str(rng.randint(1, 20))
+
+    def solver(self, dataset_name, rng):
+        if rng.random() < self.not_ready_rate:
+            return {
+                "thought": self.filler(rng),
+                "action": "Filter rows where 'Year' is 2020",
+                "intermediate_table": "| Year | Value |\n|------|-------|\n| 2020 | 100 |",
+                "answer": "<NOT_READY>",
+            }
+        return {
+            "thought": self.filler(rng),
+            "action": "Determine the answer",
+            "intermediate_table": "<NOT_CHANGED>",
+            "answer": self.answer(dataset_name, rng),
+        }
+
+    def checker(self, dataset_name, rng):
+        passed = rng.random() < self.pass_rate
+        if dataset_name == TAB_NAME:
+            score = 1 if passed else 0
+            return {"feedback": {"answer_type_checking": {"score": score, "comments": self.filler(rng)}}}
+        feedback = {}
+        for aspect in ["answer_type_checking", "format_validation", "logical_consistency"]:
+            feedback[aspect] = {"score": 2, "comments": self.filler(rng)}
+        if not passed:
+            feedback[rng.choice(list(feedback))]["score"] = rng.choice([0, 1])
+        feedback["summary"] = {"total_score": sum(details["score"] for details in feedback.values()), "final_comments": self.filler(rng)}
+        return {"feedback": feedback}
+
+    def result_analyze(self, rng):
+        return {
+            "question_type": rng.choice(["lookup", "filter+count", "aggregation", "comparison"]),
+            "required_operations": ["filter", "compare"],
+            "context": self.filler(rng),
+            "keywords": ["filter", "compare"],
+            "tags": ["comparison", "multi-step"],
+            "correct_steps": ["Filter the relevant rows", "Compare the values"],
+            "wrong_steps": [],
+            "error_type": "none",
+            "error_reason": "none",
+        }
@@ -0,0 +1,153 @@
+import asyncio
+import time
+from const import *
+
+OVERLOAD_STATUS_CODES = [429, 500, 502, 503, 504]
+LIMITER_LOG_INTERVAL = 30 # Seconds between two status lines
+BASE_LATENCY_RECOVERY = 0.01 # Share of its gap to the smoothed latency the baseline closes per request
+
+
+def estimate_tokens(prompt):
+    """Rough prompt size in tokens, about 4 characters per token."""
+    if isinstance(prompt, str):
+        return len(prompt) // 4 + 1
+    return sum(len(message['content']) for message in prompt) // 4 + 1
+
+
+def is_overload_error(error):
+    """429 and 5xx responses mean the endpoint wants fewer requests."""
+    return getattr(error, "status_code", None) in OVERLOAD_STATUS_CODES
+
+
+class TokenBucket(object):
+    """Budget of capacity units per minute, refilled continuously."""
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self.refill_rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.refill_rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount is available, requests above capacity wait for a full bucket."""
+        self.refill()
+        missing = min(amount, self.capacity) - self.available
+        return max(0.0, missing / self.refill_rate)
+
+    def take(self, amount):
+        self.available -= min(amount, self.capacity)
+
+
+class AdaptiveLimiter(object):
+    """
+    Concurrency limit for LLM requests, adjusted AIMD-style.
+
+    The limit grows by one every limit successful requests, and is halved on a
+    429/5xx response or cut by a tenth when the smoothed latency of a kind of
+    request exceeds latency_tolerance times the baseline of that kind, at most
+    once per observed request latency. The baseline follows the smoothed
+    latency down at once and back up by BASE_LATENCY_RECOVERY per request, so
+    a quiet period does not pin it low for the rest of the run. The kind is
+    the agent, so long Solver generations are not mistaken for congestion
+    compared to short Checker hops. Requests per minute and prompt tokens per minute
+    are capped by token buckets when rpm/tpm are given.
+    """
+    def __init__(self, initial=MAX_CONCURRENT_REQUESTS, min_limit=1, max_limit=MAX_ADAPTIVE_CONCURRENCY,
+                 rpm=None, tpm=None, latency_tolerance=3.0):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = float(min(max(initial, min_limit), self.max_limit))
+        self.latency_tolerance = latency_tolerance
+        self.request_bucket = TokenBucket(rpm) if rpm else None
+        self.token_bucket = TokenBucket(tpm) if tpm else None
+        self.in_flight = 0
+        self.latency = None # Smoothed latency of successful requests, paces the decreases
+        self.kind_latency = {} # Smoothed and baseline latency per kind of request
+        self.base_latency = {}
+        self.last_decrease = 0.0
+        self.last_log = 0.0
+        self.overloads = 0
+        # asyncio primitives belong to one event loop, they are recreated when the loop changes
+        self.loop = None
+        self.condition = None
+
+    def bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.loop = loop
+            self.condition = asyncio.Condition()
+            self.in_flight = 0
+
+    async def acquire(self, prompt):
+        """Wait for a free slot under the current limit and for the rate budgets of prompt."""
+        self.bind_loop()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        try:
+            await self.wait_for_budget(estimate_tokens(prompt))
+        except asyncio.CancelledError:
+            # e.g. a hedge cancelled before it was sent, its slot goes back unobserved
+            await self.release(0.0, observed=False)
+            raise
+
+    async def wait_for_budget(self, num_tokens):
+        buckets = [(bucket, amount) for bucket, amount in [(self.request_bucket, 1), (self.token_bucket, num_tokens)] if bucket is not None]
+        while buckets:
+            delay = max(bucket.wait_time(amount) for bucket, amount in buckets)
+            if delay <= 0:
+                for bucket, amount in buckets:
+                    bucket.take(amount)
+                return
+            await asyncio.sleep(delay)
+
+    async def release(self, latency, overloaded=False, observed=True, kind=None):
+        """
+        Free the slot of a finished request and adapt the limit to its outcome.
+        A request that was cancelled is not observed, its latency says nothing.
+        """
+        async with self.condition:
+            self.in_flight -= 1
+            if overloaded:
+                self.overloads += 1
+                self.decrease(0.5, "overloaded endpoint")
+            elif observed:
+                self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+                smoothed = self.kind_latency.get(kind)
+                smoothed = latency if smoothed is None else 0.9 * smoothed + 0.1 * latency
+                self.kind_latency[kind] = smoothed
+                base_latency = self.base_latency.get(kind, smoothed)
+                if smoothed < base_latency:
+                    base_latency = smoothed
+                else:
+                    base_latency += BASE_LATENCY_RECOVERY * (smoothed - base_latency)
+                self.base_latency[kind] = base_latency
+                if smoothed > self.latency_tolerance * base_latency:
+                    self.decrease(0.9, f"{kind or 'request'} latency {smoothed:.2f}s over {self.latency_tolerance}x {base_latency:.2f}s")
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+        self.log_status()
+
+    def decrease(self, factor, reason):
+        # One decrease per round trip, the requests already in flight saw the same condition
+        now = time.monotonic()
+        if now - self.last_decrease < (self.latency or 0.0):
+            return
+        self.last_decrease = now
+        old_limit = int(self.limit)
+        self.limit = max(self.min_limit, self.limit * factor)
+        if int(self.limit) != old_limit:
+            print(f"Concurrency limit {old_limit} -> {int(self.limit)}: {reason}")
+
+    def log_status(self):
+        now = time.monotonic()
+        if now - self.last_log < LIMITER_LOG_INTERVAL:
+            return
+        self.last_log = now
+        latency = f"{self.latency:.2f}s" if self.latency is not None else "n/a"
+        print(f"Concurrency limit {int(self.limit)}, {self.in_flight} in flight, smoothed latency {latency}, {self.overloads} overloaded responses")
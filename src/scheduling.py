@@ -0,0 +1,218 @@
+import collections
+import hashlib
+import json
+import time
+from const import *
+
+# Hops that are closest to END_NAME go first under the closest_to_end policy
+STAGE_RANK = {
+    CHECKER_NAME: 0,
+    REFLECTOR_NAME: 1,
+    BASELINE_NAME: 2,
+    RA_NAME: 2,
+    REASONER_NAME: 3,
+}
+
+
+def table_size(user_message):
+    """Table size computed at load time by preload_wiki_data/process_tabfact_table."""
+    return (user_message.get('num_tokens', 0), user_message.get('num_rows', 0) * user_message.get('num_columns', 0))
+
+
+def order_dataset(user_messages, active_user_messages):
+    return active_user_messages
+
+
+def order_longest_first(user_messages, active_user_messages):
+    return sorted(active_user_messages, key=lambda i: table_size(user_messages[i]), reverse=True)
+
+
+def order_shortest_first(user_messages, active_user_messages):
+    return sorted(active_user_messages, key=lambda i: table_size(user_messages[i]))
+
+
+def order_closest_to_end(user_messages, active_user_messages):
+    return sorted(active_user_messages, key=lambda i: STAGE_RANK.get(user_messages[i]['send_to'], len(STAGE_RANK)))
+
+
+ORDER_POLICIES = {
+    'dataset': order_dataset,
+    'longest_first': order_longest_first,
+    'shortest_first': order_shortest_first,
+    'closest_to_end': order_closest_to_end,
+}
+
+
+def table_key(user_message):
+    """TabFact messages keep their table_id, WikiTQ messages only the table text."""
+    if 'table_id' in user_message:
+        return user_message['table_id']
+    return hashlib.sha1(str(user_message.get('origin_table', '')).encode('utf-8')).hexdigest()
+
+
+def group_by_prefix(user_messages, active_user_messages):
+    """
+    Regroup the ordered messages by agent system prompt, then by table, so prompts that
+    share a prefix reach the server together and consecutive prompts only switch system
+    prompts once per agent. Agent blocks and the table groups inside a block keep the
+    order in which they first appear under the order policy, as do the messages of a group.
+    """
+    blocks = {}
+    for i in active_user_messages:
+        tables = blocks.setdefault(user_messages[i]['send_to'], {})
+        tables.setdefault(table_key(user_messages[i]), []).append(i)
+    return [i for tables in blocks.values() for group in tables.values() for i in group]
+
+
+PREFIX_BLOCK_CHARS = 64 # Roughly one 16-token KV cache block
+
+
+def prompt_text(prompt):
+    if isinstance(prompt, str):
+        return prompt
+    return "".join(message['content'] for message in prompt)
+
+
+def prefix_block_hashes(text):
+    """Chained hashes of the full blocks of text, equal hashes at block k mean equal prefixes up to k."""
+    hashes = []
+    h = 0
+    for start in range(0, len(text) - PREFIX_BLOCK_CHARS + 1, PREFIX_BLOCK_CHARS):
+        h = hash((h, text[start:start + PREFIX_BLOCK_CHARS]))
+        hashes.append(h)
+    return hashes
+
+
+def shared_prefix_blocks(hashes, other):
+    low, high = 0, min(len(hashes), len(other))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if hashes[mid - 1] == other[mid - 1]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def estimate_prefix_hit_ratio(prompts, window=MAX_CONCURRENT_REQUESTS):
+    """
+    Estimate the share of prompt blocks that hit the prefix cache when prompts are
+    submitted in this order. A block counts as a hit when one of the previous
+    window prompts, the ones likely still in flight or hot, shares the prefix up to it.
+    """
+    recent = collections.deque(maxlen=window)
+    hit_blocks = 0
+    total_blocks = 0
+    for prompt in prompts:
+        hashes = prefix_block_hashes(prompt_text(prompt))
+        hit_blocks += max((shared_prefix_blocks(hashes, other) for other in recent), default=0)
+        total_blocks += len(hashes)
+        recent.append(hashes)
+    return hit_blocks / total_blocks if total_blocks > 0 else 0.0
+
+
+def sum_counts(counts_list):
+    total = collections.Counter()
+    for counts in counts_list:
+        total.update(counts)
+    return dict(total)
+
+
+def dedup_ratios(agent_prompts, deduplicated):
+    """Per agent, the fraction of prompts answered by another prompt's request."""
+    return {name: round(deduplicated.get(name, 0) / count, 4) for name, count in agent_prompts.items() if count > 0}
+
+
+def compare_invalid_formats(summary, baseline):
+    """
+    Per-agent invalid format responses of a run against a baseline run's report
+    summary, e.g. one without guided decoding. Each invalid response is an extra
+    LLM round, so the baseline's count, scaled to this run's number of finished
+    messages, minus this run's count is the number of retry rounds saved.
+    """
+    scale = summary['finished'] / baseline['finished'] if baseline.get('finished') else 1.0
+    comparison = {}
+    for name in sorted(set(summary['invalid_formats']) | set(baseline.get('invalid_formats', {}))):
+        expected = baseline.get('invalid_formats', {}).get(name, 0) * scale
+        invalid = summary['invalid_formats'].get(name, 0)
+        comparison[name] = {
+            'invalid_formats': invalid,
+            'baseline_invalid_formats': round(expected, 1),
+            'invalid_format_rate': round(invalid / summary['agent_hops'][name], 4) if summary['agent_hops'].get(name) else 0.0,
+            'rounds_saved': round(expected - invalid, 1),
+        }
+    return comparison
+
+
+class ThroughputReport(object):
+    """Per-round timings of the Coordinator, used to compare ordering policies."""
+    def __init__(self, order_policy, prefix_grouping=False):
+        self.order_policy = order_policy
+        self.prefix_grouping = prefix_grouping
+        self.start_time = time.time()
+        self.rounds = []
+
+    def record_round(self, num_prompts, num_finished, prepare_time, generate_time, process_time, prefix_hit_ratio=None,
+                     stragglers=0, straggler_time=0.0, transport_errors=0, agent_hops=None, invalid_formats=None,
+                     dedup_stats=None):
+        elapsed = prepare_time + generate_time + process_time
+        agent_prompts, deduplicated = dedup_stats or ({}, {})
+        stats = {
+            'round': len(self.rounds) + 1,
+            'prompts': num_prompts,
+            'finished': num_finished,
+            'prepare_time': round(prepare_time, 3),
+            'generate_time': round(generate_time, 3),
+            'process_time': round(process_time, 3),
+            'prompts_per_second': round(num_prompts / elapsed, 3) if elapsed > 0 else 0.0,
+            'prefix_hit_ratio': round(prefix_hit_ratio, 4) if prefix_hit_ratio is not None else None,
+            'stragglers': stragglers,
+            'straggler_time': round(straggler_time, 3),
+            'transport_errors': transport_errors,
+            'agent_hops': dict(agent_hops or {}),
+            'invalid_formats': dict(invalid_formats or {}),
+            'agent_prompts': dict(agent_prompts),
+            'deduplicated': dict(deduplicated),
+        }
+        self.rounds.append(stats)
+        print(f"Round {stats['round']} stats: {stats['prompts']} prompts, {stats['finished']} finished, "
+              f"{stats['prompts_per_second']} prompts/s, generation {stats['generate_time']}s, "
+              f"estimated prefix hit ratio {stats['prefix_hit_ratio']}, "
+              f"{stats['stragglers']} stragglers requeued after {stats['straggler_time']}s, "
+              f"{stats['transport_errors']} requeued after transport errors, "
+              f"{sum(stats['invalid_formats'].values())} invalid format responses, "
+              f"{sum(stats['deduplicated'].values())} deduplicated prompts")
+        return stats
+
+    def summary(self):
+        wall_time = time.time() - self.start_time
+        num_prompts = sum(r['prompts'] for r in self.rounds)
+        num_finished = sum(r['finished'] for r in self.rounds)
+        generate_time = sum(r['generate_time'] for r in self.rounds)
+        measured = [r for r in self.rounds if r['prefix_hit_ratio'] is not None]
+        measured_prompts = sum(r['prompts'] for r in measured)
+        return {
+            'order_policy': self.order_policy,
+            'prefix_grouping': self.prefix_grouping,
+            'prefix_hit_ratio': round(sum(r['prefix_hit_ratio'] * r['prompts'] for r in measured) / measured_prompts, 4) if measured_prompts > 0 else None,
+            'rounds': len(self.rounds),
+            'prompts': num_prompts,
+            'finished': num_finished,
+            'wall_time': round(wall_time, 3),
+            'generate_time': round(generate_time, 3),
+            'client_overhead_time': round(wall_time - generate_time, 3),
+            'stragglers': sum(r['stragglers'] for r in self.rounds),
+            'straggler_time': round(sum(r['straggler_time'] for r in self.rounds), 3),
+            'transport_errors': sum(r['transport_errors'] for r in self.rounds),
+            'agent_hops': sum_counts(r.get('agent_hops', {}) for r in self.rounds),
+            'invalid_formats': sum_counts(r.get('invalid_formats', {}) for r in self.rounds),
+            'dedup_ratio': dedup_ratios(sum_counts(r.get('agent_prompts', {}) for r in self.rounds),
+                                        sum_counts(r.get('deduplicated', {}) for r in self.rounds)),
+            'prompts_per_second': round(num_prompts / wall_time, 3) if wall_time > 0 else 0.0,
+            'messages_per_second': round(num_finished / wall_time, 3) if wall_time > 0 else 0.0,
+        }
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({'summary': self.summary(), 'rounds': self.rounds}, f, indent=2)
+        print(f"Throughput report saved to {path}")
@@ -1,5 +1,9 @@
 import pandas as pd
 import json
+import os
+import zlib
+import itertools
+from collections import OrderedDict
 from const import *
 from transformers import AutoTokenizer
 import tqdm
@@ -65,6 +69,115 @@ def extract_json_from_text(text: str) -> str:
     return text
 
 
+class JsonObjectScanner(object):
+    """
+    Incremental version of the brace matching in extract_json_from_text.
+    feed() takes the response as it streams in and returns True once it holds a
+    ```json block whose JSON object parses and whose closing fence has arrived.
+    Objects outside a ```json block, such as an example shown before the answer,
+    never end the response, since parse_json takes the fenced block. A leading
+    <think> block is skipped, so braces in the model's reasoning are ignored too.
+    """
+    FENCE = "```"
+    JSON_FENCE = "```json"
+
+    def __init__(self):
+        self.text = ""
+        self.pos = 0 # Next character to scan
+        self.start = None
+        self.count = 0
+        self.in_string = False
+        self.escape_char = False
+        self.think_done = False
+        self.think_start = None # Position of <think> once it has arrived
+        self.in_block = False # Inside a ```json block
+        self.object_end = None # End of the block's complete object, waiting for the closing fence
+
+    def feed(self, chunk: str) -> bool:
+        # The tags are searched in the new chunk and the few characters before
+        # it where a tag may have started, not in the whole response again
+        previous = len(self.text)
+        self.text += chunk
+        if not self.think_done and self.think_start is None:
+            found = self.text.find("<think>", max(0, previous - len("<think>") + 1))
+            if found != -1:
+                self.think_start = found
+        if not self.think_done and self.think_start is not None:
+            end = self.text.find("</think>", max(self.think_start, previous - len("</think>") + 1))
+            if end == -1:
+                return False
+            self.think_done = True
+            self.pos = end + len("</think>")
+            self.start = None
+            self.in_block = False
+
+        while True:
+            if self.object_end is not None:
+                found = self.text.find(self.FENCE, self.object_end)
+                between = self.text[self.object_end:] if found == -1 else self.text[self.object_end:found]
+                if found != -1 and between.strip() == "":
+                    self.pos = found + len(self.FENCE)
+                    return True
+                if found == -1 and between.rstrip("`").strip() == "":
+                    return False
+                # More than the object in the block, keep scanning it like extract_json_from_text would parse it
+                self.pos, self.object_end = self.object_end, None
+            if not self.in_block:
+                found = self.text.find(self.JSON_FENCE, self.pos)
+                if found == -1:
+                    # A fence may have started in the last few characters
+                    self.pos = max(self.pos, len(self.text) - len(self.JSON_FENCE) + 1)
+                    return False
+                self.pos, self.in_block, self.start = found + len(self.JSON_FENCE), True, None
+            if not self.scan_block():
+                return False
+
+    def scan_block(self) -> bool:
+        """Scan the ```json block up to the end of the text. True once it closed or its object did."""
+        for i in range(self.pos, len(self.text)):
+            char = self.text[i]
+            if self.start is None:
+                if char == "{":
+                    self.start, self.count, self.in_string, self.escape_char = i, 1, False, False
+                elif char == "`":
+                    if len(self.text) - i < len(self.FENCE):
+                        # Maybe the start of the closing fence, decided by the next chunk
+                        self.pos = i
+                        return False
+                    if self.text.startswith(self.FENCE, i):
+                        # The block closed without a valid object, look for the next one
+                        self.pos, self.in_block = i + len(self.FENCE), False
+                        return True
+                continue
+
+            if self.escape_char:
+                self.escape_char = False
+                continue
+            if char == "\\":
+                self.escape_char = True
+                continue
+
+            if char == '"':
+                self.in_string = not self.in_string
+            elif not self.in_string:
+                if char == "{":
+                    self.count += 1
+                elif char == "}":
+                    self.count -= 1
+                    if self.count == 0:
+                        try:
+                            complete = isinstance(json.loads(self.text[self.start : i + 1]), dict)
+                        except json.JSONDecodeError:
+                            complete = False
+                        self.start = None
+                        if complete:
+                            self.pos = self.object_end = i + 1
+                            return True
+                        # Not valid JSON, e.g. braces in prose, look for the next object
+        self.pos = len(self.text)
+        return False
+
+
 def parse_json(output: str, dclass: BaseModel = None) -> Dict:
     """Try to parse and validate JSON output with enhanced error handling."""
     if not output:
@@ -179,8 +292,15 @@ def get_tokenizer(model_name: str):
         encode = tokenizer.encode
     return encode
 
-def load_wikiTQ_data(input_file: str) -> pd.DataFrame:
+def load_wikiTQ_data(input_file: str, head: int = None, select=None) -> pd.DataFrame:
+    """
+    With select, only the first head rows whose id select accepts are kept, each with
+    its position in those rows as dataset_index, before any table is processed.
+    """
     wiki_data = pd.read_csv(input_file, sep="\t", on_bad_lines="skip")
+    if select is not None:
+        wiki_data = wiki_data.iloc[:head].assign(dataset_index=lambda df: range(len(df)))
+        wiki_data = wiki_data[[select(str(qs_id)) for qs_id in wiki_data["id"]]].copy()
     wiki_data["utterance"] = wiki_data["utterance"].apply(normalize_format)
     return wiki_data
 
@@ -287,8 +407,8 @@ def count_tokens_advanced(text, encode_function) -> int:
         return 0
     return len(encode_function(str(text)))
 
-def process_tabfact_table(args, tokenizer) -> list:
-    # process tabfact table
+def process_tabfact_table(args, tokenizer, table_ids=None) -> list:
+    # process tabfact table, only the ones in table_ids if given
     with open(args.input_file, "r", encoding="utf-8") as file:
         data = [json.loads(line) for line in file]
 
@@ -296,6 +416,8 @@ def process_tabfact_table(args, tokenizer) -> list:
     for item in data:
         table_id = item["table_id"]
         table_text = item["table_text"]
+        if table_ids is not None and table_id not in table_ids:
+            continue
         if table_id not in unique_tables:
             unique_tables[table_id] = table_text
 
@@ -305,24 +427,33 @@ def process_tabfact_table(args, tokenizer) -> list:
 
     # process table
     for info in tqdm.tqdm(unique_table_list, desc="Processing TabFact tables"):
-
-        # clean and change to markdown format
-        header = info["table_text"][0]
-        rows = info["table_text"][1:]
-        table_df = pd.DataFrame(rows, columns=header)
-        before_clean = table_df.to_markdown(index=False)
-        clean_table = normalize_format(before_clean)
-        info["column_list"] = table_df.columns.tolist()
-        info["table_text"] = clean_table
-
-        num_tokens = sum(count_tokens_advanced(cell, tokenizer) for _, row in table_df.iterrows() for cell in row)
-        info['num_rows'] = len(table_df)
-        info['num_columns'] = len(table_df.columns)
-        info['num_tokens'] = num_tokens
+        info.update(process_tabfact_table_text(info["table_text"], tokenizer))
         
     return unique_table_list
 
-def load_tabfact_dataset(args):
+def process_tabfact_table_text(table_text: list, tokenizer) -> dict:
+    # clean and change to markdown format
+    header = table_text[0]
+    rows = table_text[1:]
+    table_df = pd.DataFrame(rows, columns=header)
+    before_clean = table_df.to_markdown(index=False)
+    clean_table = normalize_format(before_clean)
+
+    num_tokens = sum(count_tokens_advanced(cell, tokenizer) for _, row in table_df.iterrows() for cell in row)
+    info = {
+        "column_list": table_df.columns.tolist(),
+        "table_text": clean_table,
+        "num_rows": len(table_df),
+        "num_columns": len(table_df.columns),
+        "num_tokens": num_tokens,
+    }
+    return info
+
+def load_tabfact_dataset(args, select=None):
+    """
+    With select, only the first args.head lines whose id select accepts are kept, each
+    with its line number as dataset_index, and only their tables are processed.
+    """
     tabfact_statement_raw2clean_dict = {}
     with open(args.raw2clean_path, "r") as f:
         lines = f.readlines()
@@ -338,10 +469,16 @@ def load_tabfact_dataset(args):
     #         if len(all_lines) >= first_n: break
     # else:
     all_lines = open(args.input_file).readlines()
+    if select is not None:
+        all_lines = all_lines[: args.head]
 
     for i, line in tqdm.tqdm(enumerate(all_lines), total=len(all_lines), desc=f"Loading tabfact dataset"):
+        if select is not None and not select(f"{i}"):
+            continue
         info = json.loads(line)
         info["id"] = f"{i}"
+        if select is not None:
+            info["dataset_index"] = i
         
         # process statement
         if info["statement"] in tabfact_statement_raw2clean_dict:
@@ -361,7 +498,8 @@ def load_tabfact_dataset(args):
     
     tokenizer = get_tokenizer(args.llm_in_use)
 
-    table_info_list = process_tabfact_table(args, tokenizer=tokenizer)
+    table_ids = {info["table_id"] for info in dataset} if select is not None else None
+    table_info_list = process_tabfact_table(args, tokenizer=tokenizer, table_ids=table_ids)
     dataset_df = pd.DataFrame(dataset)
     table_info_df = pd.DataFrame(table_info_list)
     merged_df = dataset_df.merge(table_info_df, on="table_id", how="left")
@@ -389,3 +527,99 @@ def init_TabFact_messages(dataset: pd.DataFrame, starter: str) -> List[Dict]:
     return dataset.to_dict(orient="records")
 
 
+
+
+def get_message_id(message: Dict) -> str:
+    """WikiTQ messages carry a qs_id, TabFact messages only keep their line id."""
+    return str(message.get("qs_id", message.get("id")))
+
+def shard_of(message_id: str, num_shards: int) -> int:
+    return zlib.crc32(message_id.encode("utf-8")) % num_shards
+
+def shard_file_path(path: str, num_shards: int, shard_index: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard_index}of{num_shards}{ext}"
+
+
+class TableInfoCache(object):
+    """Bounded LRU cache of processed tables, so streaming loaders never hold every table."""
+    def __init__(self, process_table, max_size=STREAM_TABLE_CACHE_SIZE):
+        self.process_table = process_table
+        self.max_size = max_size
+        self.tables = OrderedDict()
+
+    def get(self, key, *process_args):
+        if key in self.tables:
+            self.tables.move_to_end(key)
+        else:
+            self.tables[key] = self.process_table(*process_args)
+            if len(self.tables) > self.max_size:
+                self.tables.popitem(last=False)
+        return self.tables[key]
+
+def init_message(message: Dict, starter: str) -> Dict:
+    """The per-message fields that init_wikiTQ_messages/init_TabFact_messages add as columns."""
+    message["checker_result"] = []
+    message["reasoner_result"] = []
+    message["baseline_result"] = []
+    message["reflector_result"] = []
+    message["first_round_in_loop"] = True
+    message["total_round"] = 0
+    message["send_to"] = AGENT_NAME_MAP[starter]
+    return message
+
+def iter_wikiTQ_messages(args, starter: str, select=None):
+    """
+    Lazily yield (dataset_index, message) with the same fields as init_wikiTQ_messages.
+    Rows whose id is rejected by select are skipped before their table is processed.
+    """
+    tokenizer = get_tokenizer(args.llm_in_use)
+    table_cache = TableInfoCache(lambda table_path: process_wiki_table(args, table_path, tokenizer))
+    chunks = pd.read_csv(args.input_file, sep="\t", on_bad_lines="skip", chunksize=1000)
+    records = (record for chunk in chunks for record in chunk.to_dict(orient="records"))
+    for i, record in enumerate(itertools.islice(records, args.head)):
+        if select is not None and not select(str(record["id"])):
+            continue
+        table_info = table_cache.get(record["context"], record["context"])
+        message = {
+            "qs_id": record["id"],
+            "query": normalize_format(record["utterance"]),
+            "ground_truth": record["targetValue"],
+            "num_rows": table_info["num_rows"],
+            "num_columns": table_info["num_columns"],
+            "num_tokens": table_info["num_tokens"],
+            "column_list": table_info["column_list"],
+            "origin_table": table_info["table_markdown"],
+        }
+        yield i, init_message(message, starter)
+
+def iter_TabFact_messages(args, starter: str, select=None):
+    """
+    Lazily yield (dataset_index, message) with the same fields as
+    load_tabfact_dataset followed by init_TabFact_messages.
+    Lines whose id is rejected by select are skipped before their table is processed.
+    """
+    tabfact_statement_raw2clean_dict = {}
+    with open(args.raw2clean_path, "r") as f:
+        for line in f:
+            info = json.loads(line)
+            tabfact_statement_raw2clean_dict[info["statement"]] = info["cleaned_statement"]
+
+    tokenizer = get_tokenizer(args.llm_in_use)
+    table_cache = TableInfoCache(lambda table_text: process_tabfact_table_text(table_text, tokenizer))
+    with open(args.input_file, "r", encoding="utf-8") as f:
+        for i, line in enumerate(itertools.islice(f, args.head)):
+            if select is not None and not select(f"{i}"):
+                continue
+            info = json.loads(line)
+            info["id"] = f"{i}"
+            info["query"] = normalize_format(tabfact_statement_raw2clean_dict.get(info["statement"], info["statement"]))
+            info["ground_truth"] = 'true' if info['label'] == 1 else 'false'
+
+            table_info = table_cache.get(info["table_id"], info.pop("table_text"))
+            info["column_list"] = table_info["column_list"]
+            info["origin_table"] = table_info["table_text"]
+            info["num_rows"] = table_info["num_rows"]
+            info["num_columns"] = table_info["num_columns"]
+            info["num_tokens"] = table_info["num_tokens"]
+            yield i, init_message(info, starter)
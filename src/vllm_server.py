@@ -0,0 +1,187 @@
+import os
+import signal
+import socket
+import subprocess
+import time
+import requests
+from urllib.parse import urlparse
+from const import *
+
+
+def is_reasoning_model(llm_in_use):
+    return any([u in llm_in_use for u in ["deepseek", "QWQ"]])
+
+
+def start_vllm(llm_in_use, max_tokens=MAX_MODEL_LEN, port=VLLM_PORT, tensor_parallel_size=2):
+    env = os.environ.copy()
+    env["VLLM_USE_V1"] = "0"
+    model_arg = f"--model {llm_in_use}"
+    if is_reasoning_model(llm_in_use):
+        model_arg += " --reasoning-parser deepseek_r1 --enable-reasoning"
+
+    vllm_cmd = f"""
+    python -m vllm.entrypoints.openai.api_server \
+    {model_arg} \
+    --dtype bfloat16 \
+    --api-key None \
+    --tensor-parallel-size {tensor_parallel_size} \
+    --host 0.0.0.0 \
+    --port {port} \
+    --max-model-len {max_tokens} \
+    --distributed-executor-backend ray \
+    --enable-chunked-prefill \
+    --gpu_memory_utilization 0.95 \
+    --disable-uvicorn-access-log \
+    --disable-log-stats \
+    --disable-log-requests \
+    --enable-prefix-caching
+    """
+
+    process = subprocess.Popen(
+        vllm_cmd.strip().split(),
+        # stdout=subprocess.PIPE,
+        # stderr=subprocess.STDOUT,
+        env=env,
+        preexec_fn=os.setsid,  # In order to use pgid later to kill the entire process group
+    )
+    print(f"vLLM server started with PID {process.pid}.")
+    return process
+
+
+def served_models(base_url, api_key=None, timeout=2):
+    """Model id to model card (vLLM's includes max_model_len) of the models served at base_url, or None when nothing answers there."""
+    try:
+        res = requests.get(f"{base_url}/models", headers={"Authorization": f"Bearer {api_key}"}, timeout=timeout)
+        if res.status_code != 200:
+            return None
+        return {model["id"]: model for model in res.json().get("data", [])}
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+
+def free_port():
+    """A port that is free on this host, for a server started on it right away."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_server(base_url, process, timeout=60):
+    """Wait for a local test server such as mock_server.py, raising if it exits or does not come up."""
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server at {base_url} exited with code {process.returncode}")
+        try:
+            if requests.get(f"{base_url}/models", timeout=1).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} is not ready after {timeout}s")
+
+
+def wait_for_vllm_ready(base_url, process=None, api_key=None, timeout=VLLM_READY_TIMEOUT):
+    """
+    Poll /v1/models with a short, growing interval until the server answers.
+    Gives up early when the server process has exited.
+    """
+    print("waiting for vLLM server to be ready...")
+    start_time = time.time()
+    interval = 0.5
+    while time.time() - start_time < timeout:
+        if served_models(base_url, api_key) is not None:
+            print(f"vLLM server is ready after {time.time() - start_time:.0f}s.")
+            return True
+        if process is not None and process.poll() is not None:
+            print(f"vLLM server exited with code {process.returncode} before it was ready.")
+            return False
+        time.sleep(interval)
+        interval = min(interval * 2, VLLM_MAX_POLL_INTERVAL)
+    print(f"vLLM server is not ready after {timeout}s.")
+    return False
+
+
+def stop_vllm(process):
+    print("Stopping vLLM server...")
+    try:
+        os.killpg(os.getpgid(process.pid), signal.SIGTERM)
+        process.wait()
+        print("vLLM server stopped.")
+    except Exception as e:
+        print(f"Error stopping vLLM server: {e}")
+
+
+class VLLMServer(object):
+    """
+    The vLLM server behind api_self_hosted mode.
+
+    A server that already serves the model at base_url is reused instead of
+    loading the model again, e.g. one left running by the previous pipeline
+    stage with keep_running. A reused server keeps its own context length,
+    max_model_len is updated to it. Only a server started here is ever
+    stopped, and not even that one with keep_running.
+    """
+    def __init__(self, model, base_url, api_key=None, tensor_parallel_size=2, max_model_len=MAX_MODEL_LEN, keep_running=False):
+        self.model = model
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.tensor_parallel_size = tensor_parallel_size
+        self.max_model_len = max_model_len
+        self.keep_running = keep_running
+        parsed = urlparse(self.base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or VLLM_PORT
+        self.process = None
+
+    def ensure_running(self):
+        models = served_models(self.base_url, self.api_key)
+        if models is not None:
+            if self.model not in models:
+                raise RuntimeError(f"{self.base_url} already serves {list(models)}, not {self.model}")
+            served_len = models[self.model].get("max_model_len")
+            if served_len is not None and served_len != self.max_model_len:
+                # The server's context length is what max_tokens has to fit in
+                print(f"Warning: the vLLM server at {self.base_url} was started with max_model_len {served_len}, "
+                      f"not {self.max_model_len}; requests are clamped to {served_len}")
+                self.max_model_len = served_len
+            print(f"Reusing the vLLM server at {self.base_url} that serves {self.model}")
+            return
+        if self.host not in ["localhost", "127.0.0.1", "0.0.0.0"]:
+            raise RuntimeError(f"No server answers at {self.base_url}, and vLLM can only be started on this host")
+        self.process = start_vllm(self.model, self.max_model_len, self.port, self.tensor_parallel_size)
+        if not wait_for_vllm_ready(self.base_url, self.process, self.api_key):
+            if self.process.poll() is None:
+                stop_vllm(self.process)
+            raise RuntimeError(f"vLLM server for {self.model} did not come up on port {self.port}")
+
+    def warmup(self, system_prompts):
+        """
+        Prefill each system prompt once so the agents' shared prefixes are in the
+        prefix cache before the first round. One output token per prompt.
+        """
+        start_time = time.time()
+        for system_prompt in system_prompts:
+            try:
+                requests.post(
+                    f"{self.base_url}/chat/completions",
+                    headers={"Authorization": f"Bearer {self.api_key}"},
+                    json={
+                        "model": self.model,
+                        "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": ""}],
+                        "max_tokens": 1,
+                    },
+                    timeout=60,
+                )
+            except requests.exceptions.RequestException as e:
+                print(f"Warmup request failed: {e}")
+        print(f"Warmed up {len(system_prompts)} system prompts in {time.time() - start_time:.1f}s")
+
+    def close(self):
+        if self.process is None:
+            return
+        if self.keep_running:
+            print(f"Leaving vLLM server (PID {self.process.pid}) running at {self.base_url} for the next stage, "
+                  f"stop it with: kill -TERM -{os.getpgid(self.process.pid)}")
+            return
+        stop_vllm(self.process)
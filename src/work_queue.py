@@ -0,0 +1,102 @@
+import json
+import os
+import sqlite3
+import time
+from const import *
+from utils import get_message_id
+
+
+class WorkQueue(object):
+    """
+    SQLite-backed queue of user messages shared by any number of run_batch.py workers.
+
+    A worker leases a few active messages, runs one agent hop on them and writes
+    them back with their new send_to. Leases expire after lease_seconds, so the
+    messages held by a crashed worker are handed out again.
+    """
+    def __init__(self, path, lease_seconds=600):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        # Autocommit mode, transactions are opened explicitly where they matter
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS messages (
+                position INTEGER PRIMARY KEY,
+                qs_id TEXT NOT NULL,
+                send_to TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                lease_owner TEXT,
+                lease_expires REAL NOT NULL DEFAULT 0
+            )"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS messages_pending ON messages (send_to, lease_expires)")
+
+    def is_empty(self):
+        return self.conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 0
+
+    def enqueue(self, user_messages):
+        """Add the messages by dataset position. Positions already queued are left untouched."""
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO messages (position, qs_id, send_to, payload) VALUES (?, ?, ?, ?)",
+                [
+                    (i, get_message_id(user_message), user_message["send_to"], json.dumps(user_message, ensure_ascii=False))
+                    for i, user_message in enumerate(user_messages)
+                ],
+            )
+
+    def lease(self, worker_id, limit):
+        """Lease up to limit active messages that nobody else holds. Returns [(position, user_message)]."""
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            rows = self.conn.execute(
+                "SELECT position, payload FROM messages WHERE send_to != ? AND lease_expires < ? ORDER BY position LIMIT ?",
+                (END_NAME, now, limit),
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE messages SET lease_owner = ?, lease_expires = ? WHERE position = ?",
+                [(worker_id, now + self.lease_seconds, position) for position, _ in rows],
+            )
+        return [(position, json.loads(payload)) for position, payload in rows]
+
+    def complete(self, worker_id, leased):
+        """
+        Write back leased messages after their hop and release them.
+        Messages whose lease already went to another worker are dropped,
+        the other worker's result wins. Returns the number of stale results
+        and whether this write finished the last active message, which is
+        true for exactly one call on a queue.
+        """
+        stale = 0
+        finished_any = False
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            for position, user_message in leased:
+                cursor = self.conn.execute(
+                    "UPDATE messages SET send_to = ?, payload = ?, lease_owner = NULL, lease_expires = 0 "
+                    "WHERE position = ? AND lease_owner = ?",
+                    (user_message["send_to"], json.dumps(user_message, ensure_ascii=False), position, worker_id),
+                )
+                if cursor.rowcount == 0:
+                    stale += 1
+                elif user_message["send_to"] == END_NAME:
+                    finished_any = True
+            finished_queue = finished_any and self.count_active() == 0
+        return stale, finished_queue
+
+    def count_active(self):
+        return self.conn.execute("SELECT COUNT(*) FROM messages WHERE send_to != ?", (END_NAME,)).fetchone()[0]
+
+    def export(self, output_file):
+        """Write every message in dataset order as the jsonl output_file."""
+        tmp_file = f"{output_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as fp:
+            for (payload,) in self.conn.execute("SELECT payload FROM messages ORDER BY position"):
+                fp.write(payload + "\n")
+        os.replace(tmp_file, output_file)
+
+    def close(self):
+        self.conn.close()
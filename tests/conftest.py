@@ -0,0 +1,41 @@
+import ast
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "src"), ROOT]
+
+from vllm_server import free_port, wait_for_server
+
+
+class MockServer(object):
+    """mock_server.py running in a subprocess, its request counts are read when it stops."""
+    def __init__(self, model, args=()):
+        self.model = model
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}/v1"
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "mock_server.py"), "--port", str(self.port), "--model", model] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+        )
+        wait_for_server(self.base_url, self.process)
+        self.counts = None
+
+    def stop(self):
+        if self.counts is None:
+            self.process.terminate()
+            output, _ = self.process.communicate(timeout=30)
+            match = re.search(r"Mock server stats: (\{.*\})", output)
+            self.counts = ast.literal_eval(match.group(1)) if match else {}
+        return self.counts
+
+
+@pytest.fixture
+def mock_server():
+    server = MockServer("mock-model", ["--time_scale", "0"])
+    yield server
+    server.stop()
@@ -0,0 +1,153 @@
+import argparse
+import json
+import os
+import pickle
+
+from batch_jobs import split_requests
+from llm import LLMWrapper, TransportFailure
+
+
+class Echo(object):
+    """Answers every request with its last message, so each response shows which prompt it belongs to."""
+    def respond(self, messages):
+        return messages[-1]["content"]
+
+
+def make_llm(tmp_path, **kwargs):
+    args = dict(llm_in_use="mock-model", llm_url=None, llm_api_key=None, inference_mode="oai_batch",
+                oai_job_dir=str(tmp_path / "jobs"), oai_emulator=str(tmp_path / "emulator"),
+                oai_emulator_time_scale=0.0)
+    args.update(kwargs)
+    llm = LLMWrapper(argparse.Namespace(**args))
+    llm.client.responder = Echo()
+    return llm
+
+
+def make_prompts(count):
+    return [[{"role": "user", "content": f"prompt {i} " + "x" * (i % 5) * 30}] for i in range(count)]
+
+
+def read_manifest(tmp_path, job_name):
+    with open(tmp_path / "jobs" / f"{job_name}_manifest.json", "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def fetch(llm, job_name, polls=10):
+    """Poll a round like run_openai_batch.py does until its results are in."""
+    for _ in range(polls):
+        results = llm.fetch_batch_job_results(job_name)
+        if results is not None:
+            return results
+    raise AssertionError(f"Job {job_name} not finished after {polls} polls")
+
+
+def test_split_requests_limits():
+    lines = ["a" * 9, "b" * 9, "c" * 9, "d" * 29, "e" * 9]
+    assert split_requests(lines, 2, 1000) == [lines[0:2], lines[2:4], lines[4:5]]
+    # Every line takes its length plus a newline
+    assert split_requests(lines, 10, 20) == [lines[0:2], lines[2:3], lines[3:4], lines[4:5]]
+    assert split_requests([], 2, 20) == []
+
+
+def test_round_is_split_and_joined_in_prompt_order(tmp_path):
+    llm = make_llm(tmp_path, oai_batch_max_requests=9, oai_batch_max_bytes=400)
+    prompts = make_prompts(50)
+    assert len(llm.submit_batch_job(prompts, "round0")) > 1
+    # A submitted round is not submitted again
+    assert llm.submit_batch_job(prompts, "round0") is None
+
+    shards = read_manifest(tmp_path, "round0")["shards"]
+    assert sum(shard["requests"] for shard in shards) == 50
+    assert all(0 < shard["requests"] <= 9 for shard in shards)
+    assert all(os.path.getsize(tmp_path / "jobs" / shard["input_file"]) <= 400 for shard in shards)
+
+    results = fetch(llm, "round0")
+    assert results == [prompt[-1]["content"].strip() for prompt in prompts]
+    # The output came back shuffled, the join by custom_id put it in order
+    output_ids = []
+    for shard in shards:
+        with open(tmp_path / "jobs" / shard["output_file"], "r", encoding="utf-8") as f:
+            output_ids.extend(json.loads(line)["custom_id"] for line in f)
+    assert sorted(output_ids) == sorted(f"request-{i}" for i in range(50))
+    assert output_ids != [f"request-{i}" for i in range(50)]
+
+
+def test_pickle_receipt_is_converted(tmp_path):
+    llm = make_llm(tmp_path)
+    prompts = make_prompts(5)
+    # A round submitted by an older run: one input file and a pickled receipt
+    os.makedirs(tmp_path / "jobs")
+    input_path = tmp_path / "jobs" / "round0.jsonl"
+    with open(input_path, "w", encoding="utf-8") as f:
+        for i, prompt in enumerate(prompts):
+            f.write(json.dumps({"custom_id": f"request-{i}", "method": "POST", "url": "/v1/chat/completions",
+                                "body": {"model": "mock-model", "messages": prompt}}) + "\n")
+    with open(input_path, "rb") as f:
+        batch_input_file = llm.client.files.create(file=f, purpose="batch")
+    reciept = llm.client.batches.create(input_file_id=batch_input_file.id, endpoint="/v1/chat/completions",
+                                        completion_window="24h")
+    with open(tmp_path / "jobs" / "round0_reciept.pkl", "wb") as f:
+        pickle.dump(reciept, f)
+
+    assert llm.submit_batch_job(prompts, "round0") is None
+    shards = read_manifest(tmp_path, "round0")["shards"]
+    assert [(shard["input_file"], shard["batch_id"], shard["requests"]) for shard in shards] == [("round0.jsonl", reciept.id, 5)]
+    assert fetch(llm, "round0") == [prompt[-1]["content"].strip() for prompt in prompts]
+
+
+def test_failed_requests_are_retried_in_follow_up_batches(tmp_path):
+    llm = make_llm(tmp_path, oai_batch_max_requests=8, oai_batch_max_retries=2)
+    validate = llm.client.validate
+    failed = []
+
+    def fail_first_batch(batch):
+        if not failed:
+            failed.append(batch["id"])
+            return [{"code": "token_limit_exceeded", "message": "Enqueued token limit reached.", "line": None}]
+        return validate(batch)
+    llm.client.validate = fail_first_batch
+
+    prompts = make_prompts(20)
+    llm.submit_batch_job(prompts, "round0")
+    # The first poll sees the failed sub-batch and submits its requests again
+    assert llm.fetch_batch_job_results("round0") is None
+    assert fetch(llm, "round0") == [prompt[-1]["content"].strip() for prompt in prompts]
+    shards = read_manifest(tmp_path, "round0")["shards"]
+    assert [shard["status"] for shard in shards].count("failed") == 1
+    assert [shard["requests"] for shard in shards if shard["attempt"] == 1] == [8]
+
+
+def test_requests_failing_every_retry_become_transport_failures(tmp_path):
+    llm = make_llm(tmp_path, oai_batch_max_requests=8, oai_batch_max_retries=2)
+    llm.client.error_rate = 1.0
+    llm.submit_batch_job(make_prompts(10), "round0")
+    results = fetch(llm, "round0")
+    assert len(results) == 10
+    assert all(isinstance(result, TransportFailure) for result in results)
+    shards = read_manifest(tmp_path, "round0")["shards"]
+    assert sorted(set(shard["attempt"] for shard in shards)) == [0, 1, 2]
+    assert all(shard["error_file"] is not None for shard in shards)
+    # The results are read back from disk without another follow-up batch
+    assert len(fetch(llm, "round0", polls=1)) == 10
+    assert len(read_manifest(tmp_path, "round0")["shards"]) == len(shards)
+
+
+def test_responses_without_content_are_retried(tmp_path):
+    llm = make_llm(tmp_path, oai_batch_max_retries=1)
+    respond = llm.client.respond
+    refused = []
+
+    def refuse_once(request):
+        result = respond(request)
+        if request["custom_id"] == "request-3" and not refused:
+            refused.append(request["custom_id"])
+            result["response"]["body"]["choices"][0]["message"].update(content=None, refusal="I can't help with that.")
+        return result
+    llm.client.respond = refuse_once
+
+    prompts = make_prompts(6)
+    llm.submit_batch_job(prompts, "round0")
+    assert llm.fetch_batch_job_results("round0") is None
+    assert fetch(llm, "round0") == [prompt[-1]["content"].strip() for prompt in prompts]
+    shards = read_manifest(tmp_path, "round0")["shards"]
+    assert [shard["requests"] for shard in shards if shard["attempt"] == 1] == [1]
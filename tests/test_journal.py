@@ -0,0 +1,107 @@
+import json
+
+import pytest
+
+from const import *
+from journal import MessageJournal, compact_journal, read_log_entries, replay_journal
+
+
+class ScriptedAgent(object):
+    """Counts the round like the real agents and sends the message where its response says."""
+    def __init__(self, name):
+        self.name = name
+
+    def process_response(self, message, llm_response, args):
+        message["total_round"] += 1
+        message.setdefault("responses", []).append(llm_response)
+        message["send_to"] = llm_response
+        return message
+
+
+AGENTS = {name: ScriptedAgent(name) for name in [REASONER_NAME, CHECKER_NAME, REFLECTOR_NAME]}
+
+
+def make_messages(count):
+    return [{"qs_id": f"q{i}", "send_to": REASONER_NAME, "total_round": 0} for i in range(count)]
+
+
+def read_output(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def run_hop(journal, user_messages, i, response):
+    """Route one response the way Coordinator.route_response does."""
+    agent_name, total_round = user_messages[i]["send_to"], user_messages[i]["total_round"]
+    user_messages[i] = AGENTS[agent_name].process_response(user_messages[i], response, None)
+    journal.record(i, agent_name, total_round, response, user_messages[i])
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return str(tmp_path / "output.jsonl"), str(tmp_path / "output.jsonl.journal")
+
+
+def test_replay_after_a_crash_partway_through_a_round(paths):
+    output_file, journal_file = paths
+    user_messages = make_messages(4)
+    compact_journal(output_file, journal_file, user_messages)
+    journal = MessageJournal(journal_file)
+    run_hop(journal, user_messages, 0, CHECKER_NAME)
+    run_hop(journal, user_messages, 2, END_NAME)
+    run_hop(journal, user_messages, 0, END_NAME)
+    journal.close()
+    # The crash tore the journal's last line
+    with open(journal_file, "a", encoding="utf-8") as f:
+        f.write('{"index": 3, "qs_id": "q3", "agent": "Sol')
+
+    restored = read_output(output_file)
+    assert replay_journal(journal_file, restored, AGENTS, None) == 3
+    assert restored == user_messages
+    assert [message["send_to"] for message in restored] == [END_NAME, REASONER_NAME, END_NAME, REASONER_NAME]
+    # The torn line is cut off, so new records start on a clean line
+    assert len(read_log_entries(journal_file)) == 3
+    # Replaying again onto the restored state applies nothing twice
+    assert replay_journal(journal_file, restored, AGENTS, None) == 0
+    assert restored == user_messages
+
+
+def test_replay_of_a_compacted_journal(paths):
+    output_file, journal_file = paths
+    user_messages = make_messages(3)
+    compact_journal(output_file, journal_file, user_messages)
+    journal = MessageJournal(journal_file)
+    run_hop(journal, user_messages, 1, CHECKER_NAME)
+    run_hop(journal, user_messages, 1, REFLECTOR_NAME)
+    journal.close()
+    compact_journal(output_file, journal_file, user_messages)
+    assert read_output(output_file) == user_messages
+
+    # A crash between replacing the output and removing the journal leaves it behind
+    leftover = [{"index": 1, "qs_id": "q1", "agent": REASONER_NAME, "total_round": 0, "response": CHECKER_NAME, "send_to": CHECKER_NAME},
+                {"index": 1, "qs_id": "q1", "agent": CHECKER_NAME, "total_round": 1, "response": REFLECTOR_NAME, "send_to": REFLECTOR_NAME}]
+    with open(journal_file, "w", encoding="utf-8") as f:
+        for entry in leftover:
+            f.write(json.dumps(entry) + "\n")
+    restored = read_output(output_file)
+    assert replay_journal(journal_file, restored, AGENTS, None) == 0
+    assert restored == user_messages
+
+    # Hops after the compaction are replayed on top of it
+    journal = MessageJournal(journal_file)
+    run_hop(journal, user_messages, 1, END_NAME)
+    journal.close()
+    restored = read_output(output_file)
+    assert replay_journal(journal_file, restored, AGENTS, None) == 1
+    assert restored == user_messages
+
+
+def test_replay_that_diverges_from_the_journal_fails(paths):
+    output_file, journal_file = paths
+    user_messages = make_messages(1)
+    compact_journal(output_file, journal_file, user_messages)
+    with open(journal_file, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"index": 0, "qs_id": "q0", "agent": REASONER_NAME, "total_round": 0,
+                            "response": CHECKER_NAME, "send_to": END_NAME}) + "\n")
+    with pytest.raises(ValueError):
+        replay_journal(journal_file, read_output(output_file), AGENTS, None)
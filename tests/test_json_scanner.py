@@ -0,0 +1,37 @@
+import pytest
+
+from utils import JsonObjectScanner, parse_json
+
+ANSWER = '```json\n{"answer": "a {brace} and \\"quotes\\"", "rows": [1, 2]}\n```'
+RESPONSES = {
+    "fenced": "Here is the result:\n" + ANSWER + "\nI hope this helps.",
+    "example_first": 'The format is {"answer": "example"}, so:\n' + ANSWER + "\nDone.",
+    "invalid_block_first": '```json\n{answer: oops}\n```\nLet me fix that.\n' + ANSWER + "\nDone.",
+    "think": '<think>Maybe ```json\n{"answer": "draft"}\n``` works</think>' + ANSWER + "\nDone.",
+    "unfenced": 'The answer is {"answer": "plain"} and more text.',
+}
+
+
+def stream(text, chunk_size):
+    """Feed text in chunks, returns the text when the scanner stopped the stream, or None."""
+    scanner = JsonObjectScanner()
+    for start in range(0, len(text), chunk_size):
+        if scanner.feed(text[start : start + chunk_size]):
+            return scanner.text
+    return None
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 100])
+@pytest.mark.parametrize("name", sorted(RESPONSES))
+def test_early_stop_parses_like_the_full_response(name, chunk_size):
+    text = RESPONSES[name]
+    stopped = stream(text, chunk_size)
+    if name == "unfenced":
+        # Without a ```json block parse_json takes the first object, the stream runs to the end
+        assert stopped is None
+        return
+    assert stopped is not None and text.startswith(stopped)
+    # The stream stops once the block's closing fence has arrived, the commentary after it is not decoded
+    answer_end = text.index(ANSWER) + len(ANSWER)
+    assert answer_end <= len(stopped) < answer_end + chunk_size
+    assert parse_json(stopped) == parse_json(text)
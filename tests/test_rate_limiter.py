@@ -0,0 +1,39 @@
+import asyncio
+
+from rate_limiter import AdaptiveLimiter
+
+
+def observe(limiter, latencies, kind="Checker"):
+    """Release one request per latency, returns the reasons of the decreases they asked for."""
+    decreases = []
+    limiter.decrease = lambda factor, reason: decreases.append(reason)
+
+    async def run():
+        for latency in latencies:
+            await limiter.acquire("prompt")
+            await limiter.release(latency, kind=kind)
+    asyncio.run(run())
+    return decreases
+
+
+def test_baseline_recovers_after_a_quiet_period():
+    limiter = AdaptiveLimiter(initial=8, max_limit=64)
+    # A warm cache makes the first requests fast
+    assert observe(limiter, [0.1] * 50) == []
+    decreases = observe(limiter, [1.0] * 1000)
+    # The slower normal load first looks like congestion, then becomes the baseline
+    assert len(decreases) > 0
+    assert observe(limiter, [1.0] * 200) == []
+    assert limiter.base_latency["Checker"] > 1.0 / limiter.latency_tolerance
+
+
+def test_congestion_still_decreases_the_limit():
+    limiter = AdaptiveLimiter(initial=8, max_limit=64)
+    observe(limiter, [1.0] * 200)
+    assert len(observe(limiter, [5.0] * 20)) > 0
+
+
+def test_baselines_are_kept_per_agent():
+    limiter = AdaptiveLimiter(initial=8, max_limit=64)
+    observe(limiter, [0.2] * 100, kind="Checker")
+    assert observe(limiter, [4.0] * 100, kind="Solver") == []
@@ -0,0 +1,85 @@
+import argparse
+
+import pytest
+
+from const import *
+from coordinator import Coordinator, load_sampling_profiles
+from llm import LLMWrapper, PromptTooLong
+
+
+def make_llm(mock_server, **kwargs):
+    args = dict(llm_in_use=mock_server.model, llm_url=mock_server.base_url, llm_api_key="EMPTY", inference_mode="api")
+    args.update(kwargs)
+    llm = LLMWrapper(argparse.Namespace(**args))
+    # One token per word, so the test needs no model tokenizer
+    llm.encode = str.split
+    return llm
+
+
+def make_options(max_tokens):
+    return {"sampling": {"max_tokens": max_tokens}}
+
+
+def long_prompt(words):
+    return [{"role": "user", "content": " ".join(["word"] * words)}]
+
+
+def test_api_endpoints_are_not_clamped_without_max_model_len(mock_server):
+    llm = make_llm(mock_server)
+    options = make_options(1024)
+    assert llm.fit_to_model_len(long_prompt(100000), options) is options
+    llm.close()
+
+
+def test_max_tokens_is_clamped_to_the_context_left_by_the_prompt(mock_server):
+    llm = make_llm(mock_server, max_model_len=2048)
+    options = make_options(1024)
+    # Short prompts are not tokenized
+    assert llm.fit_to_model_len(long_prompt(10), options) is options
+    fitted = llm.fit_to_model_len(long_prompt(1500), options)
+    assert fitted["sampling"]["max_tokens"] == 2048 - 1500 - PROMPT_TOKENS_PER_MESSAGE
+    assert options["sampling"]["max_tokens"] == 1024
+    with pytest.raises(PromptTooLong):
+        llm.fit_to_model_len(long_prompt(2048), options)
+    llm.close()
+
+
+def test_self_hosted_server_is_clamped_by_default(mock_server):
+    llm = make_llm(mock_server, inference_mode="api_self_hosted")
+    assert llm.clamp_to_model_len and llm.max_model_len == MAX_MODEL_LEN
+    llm.close()
+
+
+def test_prompt_without_room_for_output_is_not_sent(mock_server):
+    llm = make_llm(mock_server, max_model_len=2048)
+    response = llm.run_coroutine(llm.call_llm_api_async_single(long_prompt(4096), make_options(1024)))
+    llm.close()
+    assert response is None
+    assert mock_server.stop()["requests"] == 0
+
+
+def test_offline_profiles_keep_max_tokens():
+    args = argparse.Namespace(inference_mode="offline_vllm", llm_in_use="Qwen/Qwen2.5-72B-Instruct")
+    profiles = load_sampling_profiles(args)
+    assert profiles[CHECKER_NAME]["max_tokens"] == AGENT_SAMPLING_PROFILES[CHECKER_NAME]["max_tokens"]
+
+
+def test_solver_is_uncapped_by_default(mock_server):
+    args = argparse.Namespace(inference_mode="api", llm_in_use=mock_server.model)
+    profiles = load_sampling_profiles(args)
+    assert profiles[REASONER_NAME].get("max_tokens") is None
+    llm = make_llm(mock_server, max_model_len=2048)
+    options = {"sampling": profiles[REASONER_NAME]}
+    assert llm.fit_to_model_len(long_prompt(1500), options) is options
+    assert llm.api_sampling_kwargs(long_prompt(1500), options) == {}
+    llm.close()
+
+
+def test_guided_decoding_is_rejected_before_the_model_loads(monkeypatch):
+    def load_local_llm(self, model_name):
+        raise AssertionError("the offline model was loaded before the arguments were checked")
+    monkeypatch.setattr(LLMWrapper, "load_local_llm", load_local_llm)
+    args = argparse.Namespace(inference_mode="offline_vllm", llm_in_use="mock-model", llm_url=None, llm_api_key=None,
+                              dataset_name=TAB_NAME, available_agent="REASONER_NAME", guided_decoding="guided_json")
+    with pytest.raises(ValueError, match="Guided decoding"):
+        Coordinator(args)
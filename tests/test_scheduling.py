@@ -0,0 +1,23 @@
+from const import *
+from scheduling import group_by_prefix, order_longest_first
+
+
+def make_message(send_to, table_id, num_tokens):
+    return {'send_to': send_to, 'table_id': table_id, 'num_tokens': num_tokens}
+
+
+def test_prefix_groups_are_blocked_by_agent_then_table():
+    user_messages = [
+        make_message(REASONER_NAME, 't1', 50),
+        make_message(CHECKER_NAME, 't1', 40),
+        make_message(REASONER_NAME, 't2', 30),
+        make_message(CHECKER_NAME, 't2', 20),
+        make_message(REASONER_NAME, 't1', 10),
+        make_message(REFLECTOR_NAME, 't2', 5),
+    ]
+    ordered = order_longest_first(user_messages, list(range(len(user_messages))))
+    grouped = group_by_prefix(user_messages, ordered)
+    agents = [user_messages[i]['send_to'] for i in grouped]
+    # Each system prompt is sent in one run of consecutive prompts
+    assert agents == [REASONER_NAME] * 3 + [CHECKER_NAME] * 2 + [REFLECTOR_NAME]
+    assert grouped == [0, 4, 2, 1, 3, 5]
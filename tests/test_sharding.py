@@ -0,0 +1,55 @@
+import argparse
+import os
+
+import pytest
+
+import merge_shards
+import utils
+from const import *
+from run_batch import load_user_messages
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def processed_tables(monkeypatch):
+    """Counts the processed tables, with one token per word so no model tokenizer is needed."""
+    tables = []
+    process_table_text = utils.process_tabfact_table_text
+
+    def count_table(table_text, tokenizer):
+        tables.append(table_text)
+        return process_table_text(table_text, tokenizer)
+    monkeypatch.setattr(utils, "get_tokenizer", lambda model_name: str.split)
+    monkeypatch.setattr(utils, "process_tabfact_table_text", count_table)
+    return tables
+
+
+def make_args(**kwargs):
+    args = dict(dataset_name=TAB_NAME, input_file=os.path.join(ROOT, "data/TabFact/test.jsonl"),
+                raw2clean_path=os.path.join(ROOT, "data/TabFact/raw2clean.jsonl"), llm_in_use="mock-model",
+                start_agent="REASONER_NAME", head=120, num_shards=3, shard_index=0)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def test_shards_load_only_their_messages_and_tables(processed_tables):
+    full = load_user_messages(make_args())
+    all_tables = len(processed_tables)
+    shards = []
+    for shard_index in range(3):
+        del processed_tables[:]
+        shards.append(load_user_messages(make_args(shard_index=shard_index), sharded=True))
+        assert len(processed_tables) == len({message["table_id"] for message in shards[-1]})
+        assert len(processed_tables) < all_tables
+
+    merged = sorted((message for shard in shards for message in shard), key=lambda message: message["dataset_index"])
+    assert [message["dataset_index"] for message in merged] == list(range(len(full)))
+    for message in merged:
+        message.pop("dataset_index")
+    assert merged == full
+
+
+def test_merge_rejects_a_single_shard(tmp_path):
+    with pytest.raises(ValueError):
+        merge_shards.main(argparse.Namespace(output_file=str(tmp_path / "output.jsonl"), num_shards=1))
@@ -0,0 +1,42 @@
+import argparse
+
+from conftest import MockServer
+from const import *
+from coordinator import Coordinator
+from llm import LLMWrapper
+
+
+def make_args(mock_server, **kwargs):
+    args = dict(llm_in_use=mock_server.model, llm_url=mock_server.base_url, llm_api_key="EMPTY",
+                inference_mode="api_self_hosted")
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def test_warmup_reuses_the_server_and_prefills_every_prompt(mock_server):
+    llm = LLMWrapper(make_args(mock_server), warmup_prompts=["Solver system prompt", "Checker system prompt"])
+    llm.close()
+    # The running server is reused, nothing was started that close() had to stop
+    assert llm.vllm_server.process is None
+    assert mock_server.stop()["completed"] == 2
+
+
+def test_no_warmup_without_prompts(mock_server):
+    LLMWrapper(make_args(mock_server)).close()
+    assert mock_server.stop()["requests"] == 0
+
+
+def test_coordinator_warms_the_selected_agents(mock_server):
+    args = make_args(mock_server, dataset_name=TAB_NAME, available_agent="REASONER_NAME,CHECKER_NAME")
+    Coordinator(args).llm.close()
+    assert mock_server.stop()["completed"] == 2
+
+
+def test_reused_server_keeps_its_context_length():
+    server = MockServer("mock-model", ["--time_scale", "0", "--max_model_len", "8192"])
+    try:
+        llm = LLMWrapper(make_args(server))
+        llm.close()
+        assert llm.max_model_len == llm.vllm_server.max_model_len == 8192
+    finally:
+        server.stop()
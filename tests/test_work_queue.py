@@ -0,0 +1,83 @@
+import json
+import threading
+
+from const import *
+from coordinator import Coordinator
+from work_queue import WorkQueue
+
+NEXT_AGENT = {REASONER_NAME: CHECKER_NAME, CHECKER_NAME: END_NAME}
+
+
+class ScriptedCoordinator(object):
+    """Runs one hop per leased message without an LLM, Solver then Checker then END."""
+    process_work_queue = Coordinator.process_work_queue
+
+    def __init__(self):
+        self.hops = 0
+
+    def process(self, user_messages, args):
+        for user_message in user_messages:
+            if user_message["send_to"] != END_NAME:
+                user_message["path"] = user_message.get("path", []) + [user_message["send_to"]]
+                user_message["send_to"] = NEXT_AGENT[user_message["send_to"]]
+                self.hops += 1
+        return False, user_messages
+
+
+def make_messages(count):
+    return [{"qs_id": f"q{i}", "send_to": REASONER_NAME, "total_round": 0} for i in range(count)]
+
+
+def test_stale_lease_result_is_dropped(tmp_path):
+    path = str(tmp_path / "queue.db")
+    WorkQueue(path).enqueue(make_messages(1))
+    # The first worker's lease expires at once, so the second worker gets the message too
+    slow = WorkQueue(path, lease_seconds=-1)
+    fast = WorkQueue(path)
+    [(position, slow_message)] = slow.lease("slow", 1)
+    [(_, fast_message)] = fast.lease("fast", 1)
+
+    fast_message["send_to"] = CHECKER_NAME
+    assert fast.complete("fast", [(position, fast_message)]) == (0, False)
+    slow_message["send_to"] = END_NAME
+    assert slow.complete("slow", [(position, slow_message)]) == (1, False)
+
+    output_file = str(tmp_path / "output.jsonl")
+    fast.export(output_file)
+    with open(output_file, "r", encoding="utf-8") as f:
+        assert [json.loads(line)["send_to"] for line in f] == [CHECKER_NAME]
+
+
+def test_two_workers_drain_one_queue_to_a_single_export(tmp_path):
+    path = str(tmp_path / "queue.db")
+    WorkQueue(path).enqueue(make_messages(20))
+    coordinators = [ScriptedCoordinator(), ScriptedCoordinator()]
+    finished = {}
+
+    def run_worker(worker_id, coordinator):
+        queue = WorkQueue(path, lease_seconds=2)
+        finished[worker_id] = coordinator.process_work_queue(queue, worker_id, None, lease_size=3)
+        if finished[worker_id]:
+            queue.export(str(tmp_path / "output.jsonl"))
+        queue.close()
+
+    workers = [threading.Thread(target=run_worker, args=(f"worker{k}", coordinator)) for k, coordinator in enumerate(coordinators)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=60)
+
+    assert sorted(finished.values()) == [False, True]
+    # Every message got each of its hops exactly once
+    assert sum(coordinator.hops for coordinator in coordinators) == 40
+    with open(tmp_path / "output.jsonl", "r", encoding="utf-8") as f:
+        exported = [json.loads(line) for line in f]
+    assert [message["qs_id"] for message in exported] == [f"q{i}" for i in range(20)]
+    assert all(message["send_to"] == END_NAME and message["path"] == [REASONER_NAME, CHECKER_NAME] for message in exported)
+
+
+def test_worker_on_a_finished_queue_exports(tmp_path):
+    path = str(tmp_path / "queue.db")
+    queue = WorkQueue(path)
+    queue.enqueue([dict(message, send_to=END_NAME) for message in make_messages(2)])
+    assert ScriptedCoordinator().process_work_queue(queue, "late", None) is True